@@ -49,14 +49,36 @@ class Config():
 
         # DataSet
         self.dataset = EasyDict()
+        # {VGGFace2Dataset, PackedVGGFace2Dataset (util/shard_packer.py),
+        #  StreamingVGGFace2Dataset (util/shard_packer.py --shard_size)}
         self.dataset.func = 'util.datasets.VGGFace2Dataset'
         self.dataset.data_dir = './dataset/VGGFACE2/train'
+        # landmark and filtering lists: .csv or .parquet (util/csv_merger.py)
         self.dataset.landmark_path = './dataset/VGGFACE2/bb_landmark/' +\
             'test_loose_landmark.csv'
         self.dataset.identity_path = \
             './dataset/VGGFACE2/test_identity_info.csv'
         self.dataset.num_classes = 3
         self.dataset.num_channels = 3
+        # read only images of this resolution (e.g. 256) and downsample them
+        # to the current resolution, None: read pre-resized images
+        self.dataset.source_resolution = None
+        # rasterize face regions once per resolution in the dataset
+        # manifest instead of filling polygons for every sample
+        self.dataset.region_cache = False
+        # threads decoding a minibatch in each loader worker, 0: no threads
+        self.dataset.decode_threads = 0
+
+        # Data Loader
+        self.loader = EasyDict()
+        self.loader.num_workers = 4  # 0: load on the training thread
+        self.loader.prefetch_factor = 2  # batches prefetched per worker
+        self.loader.persistent_workers = True  # keep workers across epochs
+        self.loader.pin_memory = True  # only used with cuda
+        self.loader.drop_last = True  # drop the last partial batch
+        self.loader.seed = 0  # seed of the sample order, saved in checkpoints
+        # batches converted ahead on a background thread, 0: no prefetching
+        self.loader.device_prefetch = 2
 
         # Tranining
         self.test1_train = EasyDict(D_repeats=1,
@@ -83,6 +105,16 @@ class Config():
                                   num_layers=7)
 
         self.train.use_mask = True  # {inpainting , generation} mode
+        self.train.batch_mask = True  # make masks per batch on the device
+        # scale and rotate batches on the device (BatchScaleNRotate)
+        self.train.augment = EasyDict(enabled=False,
+                                      rots=(-30, 30),
+                                      scales=(.75, 1.25),
+                                      image_mode='bilinear')
+        # run D once on real and synthesized batches concatenated
+        self.train.fused_D = True
+        # spectral norm power iterations once per update of D, not per call
+        self.train.sn_step_cache = True
         self.train.mode = Mode.generation  # {inpainting , generation} mode
         if self.common.test_mode == TestMode.unit_test:
             self.train.forced_stop = True
@@ -184,6 +216,13 @@ class Config():
                                   1: 1}  # rows per batch size
         self.snapshot.enable_threading = False
 
+        # Level-specialized graphs of G and D (model/compile.py)
+        self.compile = EasyDict()
+        self.compile.enabled = False  # torch.compile, requires torch >= 2.0
+        self.compile.backend = 'inductor'
+        self.compile.mode = None  # {None, 'reduce-overhead', 'max-autotune'}
+        self.compile.cache_dir = './exp/compile_cache'  # shared by runs
+
         # Model Save & Restore
         self.checkpoint = EasyDict()
         self.checkpoint.restore = True
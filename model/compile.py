@@ -0,0 +1,233 @@
+"""Level-specialized compiled graphs of Generator and Discriminator.
+
+Generator.forward and Discriminator.forward resolve the blocks to run and
+the fade-in from cur_level on every call. A LevelCache keeps a module per
+level (max_level, fade), which is a resolution and its phase (transition
+fades in, training does not), runs forward_level with them fixed and alpha
+as a tensor input, and compiles it with torch.compile. The level changes
+only when training moves to a new resolution or phase, so each level is
+compiled once, and alpha changing every iteration of transitions causes
+no recompilation.
+
+Compiled kernels are cached on disk (inductor FX graph cache) in the cache
+directory, so a restarted job does not compile them again. Without
+torch.compile (torch < 2.0), or when compilation fails, levels run eagerly.
+The dynamo settings this needs are patched only while levels run, so other
+compiled code of the process keeps its own.
+"""
+
+import os
+import importlib
+from math import ceil
+
+import torch
+import torch.nn as nn
+
+RECOMPILE_LIMIT = 64
+
+
+def enable_disk_cache(cache_dir):
+    """Cache compiled kernels in a directory shared by runs.
+
+    Args:
+        cache_dir (str): directory of compiled kernels.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    # read by inductor when it first compiles
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR',
+                          os.path.abspath(cache_dir))
+    try:
+        import torch._inductor.config as inductor_config
+        inductor_config.fx_graph_cache = True
+    except (ImportError, AttributeError):
+        print('The inductor graph cache is not available')
+
+
+class GeneratorLevel(nn.Module):
+    """Generator with a fixed level."""
+
+    def __init__(self, G, max_level, fade):
+        """constructor.
+
+        Args:
+            G (Generator): generator, its parameters are shared.
+            max_level (int): The number of encoder and decoder blocks.
+            fade (bool): Whether fade in the highest blocks or not.
+        """
+        super(GeneratorLevel, self).__init__()
+        self.G = G
+        self.max_level = max_level
+        self.fade = fade
+
+    def forward(self, x, mask, alpha):
+        """forward."""
+        return self.G.forward_level(x, mask, self.max_level, alpha,
+                                    self.fade)
+
+
+class DiscriminatorLevel(nn.Module):
+    """Discriminator with a fixed level."""
+
+    def __init__(self, D, max_level, fade):
+        """constructor.
+
+        Args:
+            D (Discriminator): discriminator, its parameters are shared.
+            max_level (int): The number of encoder blocks.
+            fade (bool): Whether fade in the highest blocks or not.
+        """
+        super(DiscriminatorLevel, self).__init__()
+        self.D = D
+        self.max_level = max_level
+        self.fade = fade
+
+    def forward(self, x, alpha):
+        """forward."""
+        return self.D.forward_level(x, self.max_level, alpha, self.fade)
+
+
+class LevelCache(object):
+    """Cache of compiled graphs of a model by level.
+
+    Attributes:
+        model : Generator or Discriminator
+        level_class : GeneratorLevel or DiscriminatorLevel
+        compile : whether compile levels or not
+        graphs : {(max_level, fade): graph}
+        dynamo_config : torch._dynamo settings while graphs run
+
+    """
+
+    def __init__(self, model, level_class, enabled=True, backend='inductor',
+                 mode=None):
+        """constructor.
+
+        Args:
+            model (nn.Module): Generator or Discriminator.
+            level_class: GeneratorLevel or DiscriminatorLevel.
+            enabled (bool): compile levels or run them eagerly, Default is
+                            True.
+            backend (str): torch.compile backend, Default is 'inductor'.
+            mode (str): torch.compile mode, Default is None.
+        """
+        self.model = model
+        self.level_class = level_class
+        self.compile = enabled and hasattr(torch, 'compile')
+        if enabled and not self.compile:
+            print('torch.compile is not available, levels run eagerly')
+        self.backend = backend
+        self.mode = mode
+        self.graphs = {}
+
+        self.dynamo_config = {}
+        if self.compile:
+            self.dynamo = importlib.import_module('torch._dynamo')
+            # graphs failing to compile run eagerly
+            self.dynamo_config['suppress_errors'] = True
+            # every level (and input requiring grad or not) is an entry of
+            # the same forward, more than the default limit over a training
+            for name in ('recompile_limit', 'cache_size_limit'):
+                if hasattr(self.dynamo.config, name):
+                    self.dynamo_config[name] = max(
+                        getattr(self.dynamo.config, name), RECOMPILE_LIMIT)
+
+    def graph(self, max_level, fade):
+        """Get the graph of a level, compiling it on the first use.
+
+        Args:
+            max_level (int): The number of blocks of the level.
+            fade (bool): Whether fade in the highest blocks or not.
+
+        Return: callable level
+        """
+        key = (max_level, fade)
+        if key not in self.graphs:
+            level = self.level_class(self.model, max_level, fade)
+            if self.compile:
+                level = self.patch_dynamo_config(
+                    torch.compile(level, backend=self.backend,
+                                  mode=self.mode, dynamic=False))
+            self.graphs[key] = level
+        return self.graphs[key]
+
+    def patch_dynamo_config(self, graph):
+        """Run a compiled graph with dynamo_config.
+
+        dynamo reads its settings when a call compiles or looks up the
+        graph, so they are patched around calls rather than set for the
+        process.
+
+        Args:
+            graph: compiled level.
+
+        Return: callable level
+        """
+        def run(*args):
+            with self.dynamo.config.patch(self.dynamo_config):
+                return graph(*args)
+        return run
+
+    def release(self, max_level=None):
+        """Release graphs of levels other than max_level.
+
+        Args:
+            max_level (int): The number of blocks of the level to keep,
+                             Default is None (release all).
+        """
+        self.graphs = {key: graph for key, graph in self.graphs.items()
+                       if key[0] == max_level}
+
+    def resolve(self, x, cur_level):
+        """Resolve the graph and the alpha tensor of cur_level.
+
+        Args:
+            x (tensor): Input image batch.
+            cur_level (float): The level of current training status.
+
+        Return: tuple, (graph, alpha)
+        """
+        if cur_level is None:
+            cur_level = len(self.model.encblocks)
+        max_level = ceil(cur_level)
+        alpha = int(cur_level+1) - cur_level
+        # a tensor, so a new alpha is an input, not a new graph
+        alpha_tensor = torch.tensor(float(alpha), dtype=x.dtype,
+                                    device=x.device)
+        return self.graph(max_level, alpha < 1.0), alpha_tensor
+
+
+class GeneratorLevels(LevelCache):
+    """Level-specialized graphs of a Generator."""
+
+    def __init__(self, G, **kwargs):
+        """constructor.
+
+        Args:
+            G (Generator): generator.
+            kwargs: options of LevelCache.
+        """
+        super(GeneratorLevels, self).__init__(G, GeneratorLevel, **kwargs)
+
+    def __call__(self, x, mask=None, cur_level=None):
+        """Run the generator like Generator.forward."""
+        graph, alpha = self.resolve(x, cur_level)
+        return graph(x, mask, alpha)
+
+
+class DiscriminatorLevels(LevelCache):
+    """Level-specialized graphs of a Discriminator."""
+
+    def __init__(self, D, **kwargs):
+        """constructor.
+
+        Args:
+            D (Discriminator): discriminator.
+            kwargs: options of LevelCache.
+        """
+        super(DiscriminatorLevels, self).__init__(D, DiscriminatorLevel,
+                                                  **kwargs)
+
+    def __call__(self, x, cur_level=None):
+        """Run the discriminator like Discriminator.forward."""
+        graph, alpha = self.resolve(x, cur_level)
+        return graph(x, alpha)
@@ -0,0 +1,92 @@
+"""Generator frozen for inference.
+
+freeze_for_inference turns a trained Generator into a FrozenGenerator of
+a single level: spectral normalizations are folded into plain weights,
+blocks (and fromRGB / toRGB layers) the level never runs are dropped, and
+the fade-in alpha of the level is fixed, so the module is smaller to save
+and load and its forward has no level arithmetic or hooks.
+"""
+
+import copy
+from math import ceil
+
+import torch.nn as nn
+
+from util.spectral_norm import fold_spectral_norm
+
+
+class FrozenGenerator(nn.Module):
+    """Generator of a fixed level for inference.
+
+    Attributes:
+        G : generator with only the blocks of the level
+        max_level : the number of encoder and decoder blocks
+        alpha : fade-in weight of the highest resolution blocks
+        fade : whether fade in the highest resolution blocks or not
+
+    """
+
+    def __init__(self, G, cur_level=None):
+        """constructor.
+
+        Args:
+            G (Generator): trained generator, its blocks are taken over and
+                           trimmed (freeze_for_inference works on a copy).
+            cur_level (float): The level to run, Default is None (the
+                               highest level).
+        """
+        super(FrozenGenerator, self).__init__()
+        if cur_level is None:
+            cur_level = len(G.encblocks)
+        self.max_level = ceil(cur_level)
+        self.alpha = float(int(cur_level+1) - cur_level)
+        self.fade = self.alpha < 1.0
+
+        # forward_level indexes encoder blocks from the end and decoder
+        # blocks from the start, so the blocks of the level keep their index
+        G.encblocks = nn.ModuleList(G.encblocks[-self.max_level:])
+        G.decblocks = nn.ModuleList(G.decblocks[:self.max_level])
+        for i, block in enumerate(G.encblocks):
+            if not (i == 0 or (i == 1 and self.fade)):
+                block.fromRGB = None
+        for i, block in enumerate(G.decblocks):
+            if not (i == self.max_level-1 or
+                    (i == self.max_level-2 and self.fade)):
+                block.toRGB = None
+        self.G = G
+
+    def forward(self, x, mask=None):
+        """forward.
+
+        Args:
+            x (tensor): [batch_size, num_channels, height, width],
+                        Input image batch.
+            mask (tensor): [batch_size, num_channels, height, width], Defaults
+                           to None.
+
+        Returns:
+            h (tensor): [batch_size, num_channels, height, width],
+                        Generated image batch.
+
+        """
+        return self.G.forward_level(x, mask, self.max_level, self.alpha,
+                                    self.fade)
+
+
+def freeze_for_inference(G, cur_level=None):
+    """Freeze a generator of a level for inference.
+
+    The trained generator is left unchanged.
+
+    Args:
+        G (Generator): trained generator.
+        cur_level (float): The level to run, Default is None (the highest
+                           level).
+
+    Return: FrozenGenerator in eval mode without gradients
+    """
+    G = fold_spectral_norm(copy.deepcopy(G))
+    frozen = FrozenGenerator(G, cur_level).eval()
+    for p in frozen.parameters():
+        p.requires_grad_(False)
+    return frozen
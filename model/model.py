@@ -95,7 +95,7 @@ class PGConv2d(nn.Module):
         Args:
             in_channels (int): The number of input channels.
             out_channels (int): The number of output channels.
-            nonlinearity: nonlinearity function
+            nonlinearity (nn.Module): nonlinearity module or None.
             kernel_size (int): Filter kernel size, Default is 3.
             stride (int): Filter stride size, Default is 1.
             pad: pad size, Default is 1.
@@ -105,6 +105,11 @@ class PGConv2d(nn.Module):
                                  Default is False.
         """
         super(PGConv2d, self).__init__()
+        # a module keeps the forward scriptable, unlike python functions
+        if nonlinearity is not None and \
+           not isinstance(nonlinearity, nn.Module):
+            raise TypeError('nonlinearity must be an nn.Module or None, '
+                            'got %r' % (nonlinearity,))
 
         self.conv = nn.Conv2d(in_channels, out_channels,
                               kernel_size, stride, pad)
@@ -114,10 +119,18 @@ class PGConv2d(nn.Module):
         self.instancenorm = instancenorm
         self.nonlinearity = nonlinearity
         self.out_channels = out_channels
+        # (leaky) relu is applied in place on the conv output, which the
+        # backward of the conv does not need
+        self.inplace = isinstance(nonlinearity, (nn.ReLU, nn.LeakyReLU))
+        self.negative_slope = float(getattr(nonlinearity, 'negative_slope',
+                                            0.))
 
     def forward(self, x):
         """forward.
 
+        The forward has no python-only calls, so torch.jit.script compiles
+        PGConv2d without spectral normalization (a python hook).
+
         Args:
             x (tensor): [batch_size, in_channels, height, width],
                         input tensor.
@@ -128,10 +141,16 @@ class PGConv2d(nn.Module):
 
         """
         x = self.conv(x)
-        if self.nonlinearity is not None:
+        if self.inplace:
+            if self.negative_slope > 0:
+                x = F.leaky_relu(x, self.negative_slope, inplace=True)
+            else:
+                x = F.relu(x, inplace=True)
+        elif self.nonlinearity is not None:
             x = self.nonlinearity(x)
         if self.instancenorm:
-            x = nn.InstanceNorm2d(self.out_channels)(x)
+            # same as nn.InstanceNorm2d(out_channels) without a module
+            x = F.instance_norm(x)
         return x
 
 
@@ -417,6 +436,24 @@ class Generator(nn.Module):
 
         max_level = ceil(cur_level)
         alpha = int(cur_level+1) - cur_level
+        return self.forward_level(x, mask, max_level, alpha, alpha < 1.0)
+
+    def forward_level(self, x, mask, max_level, alpha, fade):
+        """Forward of a level resolved from cur_level.
+
+        Args:
+            x (tensor): [batch_size, num_channels, height, width],
+                        Input image batch.
+            mask (tensor): [batch_size, num_channels, height, width].
+            max_level (int): The number of encoder and decoder blocks.
+            alpha (float or tensor): Fade-in weight of the highest blocks.
+            fade (bool): Whether fade in the highest blocks or not.
+
+        Returns:
+            h (tensor): [batch_size, num_channels, height, width],
+                        Generated image batch.
+
+        """
         if self.use_mask:
             assert mask is not None, "mask is None put some value on it"
             x = torch.cat([x, mask], dim=1)
@@ -428,7 +465,7 @@ class Generator(nn.Module):
             hs.append(h)
             h = downsample(h, 2)
 
-            if alpha < 1.0:
+            if fade:
                 x_down = downsample(x, 2)
                 skip_connect = self.encblocks[-max_level+1].fromRGB(x_down)
                 h = h*alpha + (1-alpha)*skip_connect
@@ -458,7 +495,7 @@ class Generator(nn.Module):
             h = upsample(h, 2)  # last layer
             h = self.decblocks[max_level-1](h, hs[-level-2], True)
 
-            if alpha < 1.0:
+            if fade:
                 x_upsample = upsample(x, 2)
                 skip_connect = self.decblocks[max_level-2].toRGB(x_upsample)
                 h = h*alpha + skip_connect*(1-alpha)
@@ -763,7 +800,25 @@ class Discriminator(nn.Module):
 
         max_level = ceil(cur_level)
         alpha = int(cur_level+1) - cur_level
+        return self.forward_level(x, max_level, alpha, alpha < 1.0)
+
+    def forward_level(self, x, max_level, alpha, fade):
+        """Forward of a level resolved from cur_level.
+
+        Args:
+            x (tensor): [batch_size, num_channels, height, width],
+                        Input image batch.
+            max_level (int): The number of encoder blocks.
+            alpha (float or tensor): Fade-in weight of the highest blocks.
+            fade (bool): Whether fade in the highest blocks or not.
+
+        Returns:
+            cls (tensor): [batch_size, num_classes],
+                          Predicted prob of each class.
+            pix_cls (tensor): pixelwise classes, None for levels without
+                              the pixel classifier.
 
+        """
         # encoder
         hs = []
         if max_level > 1:
@@ -771,7 +826,7 @@ class Discriminator(nn.Module):
             hs.append(h)
             h = downsample(h, 2)
 
-            if alpha < 1.0:
+            if fade:
                 x_down = downsample(x, 2)
                 skip_connect = self.encblocks[-max_level+1].fromRGB(x_down)
                 h = h*alpha + (1-alpha)*skip_connect
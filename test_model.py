@@ -0,0 +1,89 @@
+"""Model test code."""
+from math import ceil
+
+import torch
+import torch.nn as nn
+
+from model.compile import DiscriminatorLevels, GeneratorLevels
+from model.inference import freeze_for_inference
+from model.model import Discriminator, Generator, PGConv2d
+
+
+def test_pgconv2d_script():
+    """Scripted PGConv2d matches its python forward."""
+    x = torch.randn(2, 4, 8, 8)
+    for nonlinearity in (nn.LeakyReLU(0.2), nn.ReLU(), nn.Tanh(), None):
+        for instancenorm in (True, False):
+            conv = PGConv2d(4, 8, nonlinearity, instancenorm=instancenorm)
+            scripted = torch.jit.script(conv)
+            assert torch.allclose(conv(x), scripted(x), atol=1e-6)
+
+    try:
+        PGConv2d(4, 8, 3)
+    except TypeError:
+        pass
+    else:
+        raise AssertionError('nonlinearity which is not a module')
+
+
+def test_freeze_for_inference():
+    """Frozen generators match the generator at their level."""
+    torch.manual_seed(0)
+    G = Generator([1, 3, 32, 32], fmap_base=64, fmap_max=32,
+                  latent_size=32).eval()
+    num_params = sum(p.numel() for p in G.parameters())
+    for cur_level in (1, 2, 2.25, 3.5, 4):
+        resolution = 2 ** (ceil(cur_level) + 1)
+        x = torch.randn(2, 3, resolution, resolution)
+        mask = torch.rand(2, 1, resolution, resolution)
+        frozen = freeze_for_inference(G, cur_level)
+        with torch.no_grad():
+            expected = G(x, mask, cur_level=cur_level)
+            assert torch.allclose(frozen(x, mask), expected, atol=1e-5)
+        assert not any(p.requires_grad for p in frozen.parameters())
+        assert sum(p.numel() for p in frozen.parameters()) < num_params
+    # the trained generator is left unchanged
+    assert sum(p.numel() for p in G.parameters()) == num_params
+
+
+def test_level_cache():
+    """Compiled levels match the models and release unused levels."""
+    torch.manual_seed(0)
+    G = Generator([1, 3, 32, 32], fmap_base=64, fmap_max=32,
+                  latent_size=32).eval()
+    D = Discriminator([1, 3, 32, 32], 3, fmap_base=64, fmap_max=32,
+                      latent_size=32).eval()
+    dynamo = torch._dynamo.config
+    suppress_errors = dynamo.suppress_errors
+    G_run = GeneratorLevels(G, backend='eager')
+    D_run = DiscriminatorLevels(D, backend='eager')
+
+    # a fade level and a training level
+    for cur_level in (2.5, 3):
+        x = torch.randn(2, 3, 16, 16)
+        mask = torch.rand(2, 1, 16, 16)
+        with torch.no_grad():
+            assert torch.allclose(G_run(x, mask, cur_level),
+                                  G(x, mask, cur_level=cur_level),
+                                  atol=1e-5)
+            for compiled, expected in zip(D_run(x, cur_level),
+                                          D(x, cur_level=cur_level)):
+                assert torch.allclose(compiled, expected, atol=1e-5)
+    assert set(G_run.graphs) == set(D_run.graphs) == {(3, True), (3, False)}
+    # dynamo settings of the process are left unchanged
+    assert dynamo.suppress_errors == suppress_errors
+
+    with torch.no_grad():
+        G_run(torch.randn(2, 3, 8, 8), torch.rand(2, 1, 8, 8), 2)
+    assert set(G_run.graphs) == {(3, True), (3, False), (2, False)}
+    G_run.release(3)
+    assert set(G_run.graphs) == {(3, True), (3, False)}
+    G_run.release()
+    assert not G_run.graphs
+
+
+if __name__ == "__main__":
+    test_pgconv2d_script()
+    test_freeze_for_inference()
+    test_level_cache()
+    print('Done')
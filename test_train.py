@@ -48,6 +48,34 @@ class MyConfig(Config):
                                  256: 2}  # Resolution-specific overrides
 
 
+class CompileConfig(MyConfig):
+    """Configuration training a few iterations with compiled levels."""
+
+    def __init__(self):
+        """Initialize all config variables."""
+        super().__init__()
+        self.train.total_size = 8
+        self.train.train_size = 4
+        self.train.transition_size = 4
+        self.train.forced_stop = True
+        self.train.forced_stop_resolution = 8
+        self.checkpoint.restore = False
+        self.loader.num_workers = 0
+
+        # the eager backend runs the level graphs without inductor
+        self.compile.enabled = True
+        self.compile.backend = 'eager'
+
+
+def test_compiled_training(cfg=None):
+    """Train a few iterations with level-specialized compiled graphs."""
+    facegen = FaceGen(cfg or CompileConfig())
+    facegen.train()
+    # 8x8 has transition (fade) and training levels, 4x4 is released
+    assert set(facegen.G_run.graphs) == {(2, True), (2, False)}
+    assert set(facegen.D_run.graphs) == {(2, True), (2, False)}
+
+
 if __name__ == "__main__":
     begin_time = dt.datetime.now()
     env = sys.argv[1] if len(sys.argv) > 2 else 'myconfig'
@@ -0,0 +1,421 @@
+"""Utility test code."""
+import os
+import struct
+import tempfile
+from unittest import mock
+
+import cv2
+import numpy as np
+import torch
+
+import util.custom_transforms as dt
+from util.datasets import PackedVGGFace2Dataset, StreamingVGGFace2Dataset
+from util.image_generator import ResizedImageSaver
+from util.manifest import DatasetManifest
+from util import tfrecord
+from util.sampler import InfiniteSampler
+from util.tfrecord_extractor import extract_tfrecord_file
+from util.shard_packer import ShardPacker, load_packed, packed_paths, \
+    shard_names, write_packed
+
+
+def test_batch_scale_n_rotate_fill():
+    """Pixels warped from outside normalized images are black."""
+    normalize = dt.BatchNormalize(0.5, 0.5)
+    augment = dt.BatchScaleNRotate(rots=(30, 30), scales=(.5, .5),
+                                   fill=-normalize.mean / normalize.std)
+    image = torch.full((2, 3, 16, 16), 255, dtype=torch.uint8)
+    mask = torch.ones(2, 1, 16, 16)
+    sample = augment(normalize({'image': image, 'real_mask': mask}))
+
+    # corners are outside the rotated and shrunk input
+    corners = sample['image'][:, :, [0, 0, -1, -1], [0, -1, 0, -1]]
+    assert torch.allclose(corners, torch.tensor(-1.))
+    assert torch.allclose(sample['image'][:, :, 8, 8], torch.tensor(1.))
+    assert (sample['real_mask'][:, :, [0, -1], [0, -1]] == 0).all()
+
+
+def test_image_generator_updates():
+    """Re-runs resize edited images and delete outputs of removed ones."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        save_dir = os.path.join(tmp_dir, 'train')
+        for cls_id in ('n000001', 'n000002', 'n000003'):
+            raw_dir = os.path.join(tmp_dir, 'raw', cls_id)
+            os.makedirs(raw_dir)
+            for name in ('a', 'b'):
+                cv2.imwrite(os.path.join(raw_dir, f'{name}.png'),
+                            np.zeros((16, 16, 3), np.uint8))
+
+        def resize():
+            ResizedImageSaver(os.path.join(tmp_dir, 'raw'), save_dir,
+                              resolutions_to=(4, 8), num_workers=0)
+
+        def resized(res, name, cls_id='n000001'):
+            return os.path.join(save_dir, str(res), cls_id, f'{name}.png')
+
+        def manifest_mtime(cls_id):
+            return os.stat(os.path.join(save_dir, '.image_generator',
+                                        f'{cls_id}.json')).st_mtime_ns
+
+        resize()
+        assert all(os.path.exists(resized(res, name))
+                   for res in (4, 8) for name in ('a', 'b'))
+        unchanged = manifest_mtime('n000002')
+
+        # edited in place, the directory signature is unchanged
+        raw_dir = os.path.join(tmp_dir, 'raw', 'n000001')
+        path = os.path.join(raw_dir, 'a.png')
+        cv2.imwrite(path, np.full((16, 16, 3), 255, np.uint8))
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+        os.remove(os.path.join(raw_dir, 'b.png'))
+        for name in ('a', 'b'):
+            os.remove(os.path.join(tmp_dir, 'raw', 'n000003', f'{name}.png'))
+        os.rmdir(os.path.join(tmp_dir, 'raw', 'n000003'))
+        resize()
+        assert (cv2.imread(resized(4, 'a')) == 255).all()
+        assert not any(os.path.exists(resized(res, 'b')) for res in (4, 8))
+        assert not os.path.exists(os.path.join(save_dir, '4', 'n000003'))
+        # manifests of unchanged identities are not written again
+        assert manifest_mtime('n000002') == unchanged
+        assert sorted(os.listdir(os.path.join(save_dir, '.image_generator'))) \
+            == ['n000001.json', 'n000002.json']
+
+
+def test_manifest_regions():
+    """Regions are rasterized on the resolution of the landmarks."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for res in (4, 256, 512):
+            os.makedirs(os.path.join(tmp_dir, str(res), 'n000001'))
+            open(os.path.join(tmp_dir, str(res), 'n000001', 'a.png'),
+                 'w').close()
+        paths = [os.path.join(tmp_dir, name)
+                 for name in ('lm.csv', 'id.csv', 'filt.csv')]
+        with open(paths[0], 'w') as f:
+            f.write('NAME_ID,IDX,P1X,P1Y,P2X,P2Y,P3X,P3Y,P4X,P4Y,P5X,P5Y\n'
+                    'n000001/a,0,107,177,127,163,69,81,96,147,130,148\n')
+        with open(paths[1], 'w') as f:
+            f.write('Class_ID, Name, Gender\nn000001, a, f\n')
+        with open(paths[2], 'w') as f:
+            f.write('filename,category\nn000001/a.png,Good\n')
+
+        def region(resolution, landmark_resolution=256):
+            manifest = DatasetManifest(tmp_dir, *paths,
+                                       landmark_resolution=landmark_resolution)
+            regions = manifest.regions(resolution)
+            bits = np.unpackbits(regions[0])[:resolution * resolution]
+            return bits.reshape(resolution, resolution)
+
+        region_256 = region(256)
+        assert region(4).any() and region_256.any()
+        # above the landmark resolution, polygons are scaled up
+        assert (region(512)[::2, ::2] != region_256).mean() < 0.01
+        # landmarks on 512x512 images are not scaled at 512
+        assert (region(512, landmark_resolution=512)[:256, :256] ==
+                region_256).all()
+
+
+def varint(value):
+    """Encode a protobuf varint."""
+    out = b''
+    while True:
+        b, value = value & 0x7f, value >> 7
+        if not value:
+            return out + bytes([b])
+        out += bytes([b | 0x80])
+
+
+def length_delimited(number, payload):
+    """Encode a length-delimited protobuf field."""
+    return varint(number << 3 | 2) + varint(len(payload)) + payload
+
+
+def serialize_example(features):
+    """Serialize a tf.train.Example of bytes, float32 and int64 features."""
+    entries = b''
+    for key, value in features.items():
+        if isinstance(value, bytes):  # BytesList
+            feature = length_delimited(1, length_delimited(1, value))
+        elif value.dtype == np.float32:  # packed FloatList
+            feature = length_delimited(
+                2, length_delimited(1, value.astype('<f4').tobytes()))
+        else:  # packed Int64List, negatives in two's complement
+            packed = b''.join(varint(int(v) & (2 ** 64 - 1)) for v in value)
+            feature = length_delimited(3, length_delimited(1, packed))
+        entries += length_delimited(1, length_delimited(1, key.encode()) +
+                                    length_delimited(2, feature))
+    return length_delimited(1, entries)
+
+
+def frame_record(data):
+    """Frame a record of a TFRecord file."""
+    length = struct.pack('<Q', len(data))
+    return length + struct.pack('<I', tfrecord.masked_crc32c(length)) + \
+        data + struct.pack('<I', tfrecord.masked_crc32c(data))
+
+
+def test_tfrecord_round_trip():
+    """Records written to a TFRecord file are read back and decoded."""
+    assert tfrecord.crc32c(b'123456789') == 0xe3069283
+
+    rng = np.random.RandomState(0)
+    examples = [{'data': rng.randint(0, 256, 48).astype(np.uint8).tobytes(),
+                 'shape': np.array([3, 4, 4], dtype=np.int64),
+                 'label': np.array([-5, i, 2 ** 40], dtype=np.int64),
+                 'score': rng.rand(2).astype(np.float32)}
+                for i in range(3)]
+    records = [serialize_example(example) for example in examples]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'test.tfrecords')
+        with open(path, 'wb') as f:
+            f.write(b''.join(frame_record(r) for r in records))
+
+        assert list(tfrecord.iter_tfrecord(path, check_crc=True)) == records
+        index = tfrecord.index_tfrecord(path)
+        assert index[:, 1].tolist() == [len(r) for r in records]
+
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            for (offset, length), example in zip(index[::-1],
+                                                 examples[::-1]):
+                data = tfrecord.read_record_at(fd, offset, length,
+                                               check_crc=True)
+                features = tfrecord.parse_example(data)
+                assert features['data'] == [example['data']]
+                for key in ('shape', 'label', 'score'):
+                    assert features[key].dtype == example[key].dtype
+                    assert (features[key] == example[key]).all()
+        finally:
+            os.close(fd)
+
+
+def test_tfrecord_corruption():
+    """Corrupted and truncated records raise IOError."""
+    record = frame_record(serialize_example({'data': b'image'}))
+
+    def raises(content, read):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'test.tfrecords')
+            with open(path, 'wb') as f:
+                f.write(content)
+            try:
+                read(path)
+            except IOError:
+                return True
+        return False
+
+    def read_all(path):
+        return list(tfrecord.iter_tfrecord(path, check_crc=True))
+
+    flipped = bytearray(record)
+    flipped[-6] ^= 1  # a byte of the data
+    assert raises(bytes(flipped), read_all)
+    # the crc of the data is only checked when asked for
+    assert not raises(bytes(flipped),
+                      lambda p: list(tfrecord.iter_tfrecord(p, False)))
+
+    flipped = bytearray(record)
+    flipped[0] ^= 1  # a byte of the length
+    assert raises(bytes(flipped), read_all)
+    assert raises(bytes(flipped), tfrecord.index_tfrecord)
+
+    assert raises(record + record[:-1], read_all)
+    assert raises(record + record[:5], tfrecord.index_tfrecord)
+
+
+def test_sampler_resume():
+    """A sampler restored mid-epoch continues with the next sample."""
+    dataset = range(10)
+    sampler = InfiniteSampler(dataset, seed=3)
+    stream = iter(sampler)
+    expected = [next(stream) for _ in range(40)]
+    # every epoch is a permutation, and epochs differ
+    assert sorted(expected[:10]) == sorted(expected[10:20]) == list(dataset)
+    assert expected[:10] != expected[10:20]
+
+    # the loader draws ahead of the 13 samples trained
+    loader = torch.utils.data.DataLoader(dataset, batch_size=4,
+                                         sampler=sampler)
+    batches = iter(loader)
+    for _ in range(4):
+        next(batches)
+    sampler.advance(13)
+    state_dict = sampler.state_dict()
+    assert (state_dict['epoch'], state_dict['offset']) == (1, 3)
+
+    resumed = InfiniteSampler(dataset)
+    resumed.load_state_dict(state_dict)
+    stream = iter(resumed)
+    assert [next(stream) for _ in range(27)] == expected[13:]
+
+    try:
+        InfiniteSampler(range(11)).load_state_dict(state_dict)
+    except AssertionError:
+        pass
+    else:
+        raise AssertionError('restored on another dataset')
+
+
+def test_packed_keys_match_images():
+    """Keys left by an interrupted pack are detected."""
+    with tempfile.TemporaryDirectory() as pack_dir:
+        images = [np.full((4, 4, 3), i, np.uint8) for i in range(2)]
+        write_packed(pack_dir, 4, ['a/0.png', 'a/1.png'], images, (4, 4, 3))
+        packed, keys = load_packed(pack_dir, 4)
+        assert keys.tolist() == [b'a/0.png', b'a/1.png']
+        assert (packed[1] == 1).all()
+        assert sorted(os.listdir(pack_dir)) == ['4.keys.npy', '4.npy']
+
+        # keys of a larger pack replaced before its images
+        np.save(packed_paths(pack_dir, 4)[1],
+                np.array(['a/0.png', 'a/1.png', 'b/0.png'], dtype=bytes))
+        try:
+            load_packed(pack_dir, 4)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('keys do not match images')
+
+
+def make_dataset(data_dir, num_identities, num_images, resolution=4):
+    """Write images and csv files of a small VGGFace2 dataset.
+
+    Return: [landmark, identity, filtering] csv paths
+    """
+    paths = [os.path.join(data_dir, name)
+             for name in ('lm.csv', 'id.csv', 'filt.csv')]
+    rows = [[], ['Class_ID, Name, Gender'], ['filename,category']]
+    rows[0].append('NAME_ID,IDX,P1X,P1Y,P2X,P2Y,P3X,P3Y,P4X,P4Y,P5X,P5Y')
+    for cls in range(num_identities):
+        cls_id = f'n{cls:06d}'
+        cls_dir = os.path.join(data_dir, str(resolution), cls_id)
+        os.makedirs(cls_dir)
+        rows[1].append(f'{cls_id}, a, {"f" if cls % 2 else "m"}')
+        for i in range(num_images):
+            cv2.imwrite(os.path.join(cls_dir, f'{i}.png'),
+                        np.full((resolution, resolution, 3), cls, np.uint8))
+            rows[0].append(f'{cls_id}/{i},{i},107,177,127,163,69,81,96,147,'
+                           f'130,{148 + cls * num_images + i}')
+            rows[2].append(f'{cls_id}/{i}.png,Good')
+    for path, lines in zip(paths, rows):
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+    return paths
+
+
+def test_shard_packer_repack():
+    """Shards mix identities, and re-packs leave no stale shards."""
+    with tempfile.TemporaryDirectory() as data_dir:
+        make_dataset(data_dir, 4, 4)
+        packer = ShardPacker(data_dir)
+
+        def packed_keys():
+            return [load_packed(packer.pack_dir, name)[1]
+                    for name in shard_names(packer.pack_dir, 4)]
+
+        assert packer.pack(4, shard_size=4) == 16
+        shards = packed_keys()
+        assert len(shards) == 4
+        assert sorted(np.concatenate(shards).tolist()) == \
+            sorted(f'n{c:06d}/{i}.png'.encode()
+                   for c in range(4) for i in range(4))
+        # not whole identities in order
+        assert any(len({k.split(b'/')[0] for k in keys}) > 1
+                   for keys in shards)
+
+        os.remove(os.path.join(data_dir, '4', 'n000003', '0.png'))
+        assert packer.pack(4, shard_size=8) == 15
+        assert [len(keys) for keys in packed_keys()] == [8, 7]
+        assert len(os.listdir(packer.pack_dir)) == 5
+
+
+def test_streaming_ranks():
+    """Every rank streams the same number of samples."""
+    with tempfile.TemporaryDirectory() as data_dir:
+        paths = make_dataset(data_dir, 5, 3)
+        ShardPacker(data_dir).pack(4, shard_size=2)  # 8 shards, one of 1
+        dataset = StreamingVGGFace2Dataset(data_dir, 4, *paths,
+                                           shuffle_buffer=4)
+
+        class WorkerInfo(object):
+            def __init__(self, id, num_workers):
+                self.id = id
+                self.num_workers = num_workers
+
+        for world_size in (1, 3):
+            for epoch in range(3):
+                samples = []
+                for rank in range(world_size):
+                    with mock.patch('util.datasets.dist') as dist:
+                        dist.is_initialized.return_value = True
+                        dist.get_rank.return_value = rank
+                        dist.get_world_size.return_value = world_size
+                        dataset.set_epoch(epoch)
+                        num_samples = len(dataset)
+                        rank_samples = [s['landmark'].tolist()
+                                        for s in dataset]
+                        assert len(rank_samples) == num_samples
+                        # split across workers
+                        worker_samples = []
+                        for worker_id in range(2):
+                            with mock.patch(
+                                    'util.datasets.get_worker_info',
+                                    return_value=WorkerInfo(worker_id, 2)):
+                                dataset.set_epoch(epoch)
+                                worker_samples += [s['landmark'].tolist()
+                                                   for s in dataset]
+                        assert sorted(worker_samples) == sorted(rank_samples)
+                    samples.append(rank_samples)
+                assert len({len(s) for s in samples}) == 1
+                # ranks of 2 or 3 shards, one of them with 1 sample
+                assert len(samples[0]) in ((15,) if world_size == 1
+                                           else (3, 4))
+                flat = sum(samples, [])
+                assert len({tuple(s) for s in flat}) == len(flat)
+
+
+def test_packed_record_order():
+    """Packs in record order are extracted and read by key."""
+    with tempfile.TemporaryDirectory() as data_dir:
+        # keys of the records are not sorted
+        attrs = [[1, 0], [0, 1], [1, 1]]
+        images = [np.full((3, 4, 4), i, np.uint8) for i in range(3)]
+        path = os.path.join(data_dir, 'tfrecord-r02.tfrecords')
+        with open(path, 'wb') as f:
+            for attr, image in zip(attrs, images):
+                f.write(frame_record(serialize_example(
+                    {'shape': np.array(image.shape, dtype=np.int64),
+                     'data': image.tobytes(),
+                     'attr': np.array(attr, np.uint8).tobytes()})))
+        pack_dir = os.path.join(data_dir, 'tfr_packed')
+        assert extract_tfrecord_file(path, data_dir, pack_dir) == 3
+        packed, keys = load_packed(pack_dir, 4)
+        assert keys.tolist() == [b'10_0.png', b'01_1.png', b'11_2.png']
+        assert [int(img[0, 0, 0]) for img in packed] == [0, 1, 2]
+
+        # a VGGFace2 pack with keys in reverse order
+        paths = make_dataset(data_dir, 3, 2)
+        ShardPacker(data_dir).pack(4)
+        packed, keys = load_packed(os.path.join(data_dir, 'packed'), 4)
+        write_packed(os.path.join(data_dir, 'packed'), 4, keys[::-1],
+                     np.array(packed[::-1]), (4, 4, 3))
+        dataset = PackedVGGFace2Dataset(data_dir, 4, *paths)
+        assert len(dataset) == 6
+        for i in range(len(dataset)):
+            cls = int(dataset.keys[i].split(b'/')[0][1:])
+            assert (dataset[i]['image'] == cls).all()
+
+
+if __name__ == "__main__":
+    test_batch_scale_n_rotate_fill()
+    test_image_generator_updates()
+    test_manifest_regions()
+    test_tfrecord_round_trip()
+    test_tfrecord_corruption()
+    test_sampler_resume()
+    test_packed_keys_match_images()
+    test_shard_packer_repack()
+    test_streaming_ranks()
+    test_packed_record_order()
+    print('Done')
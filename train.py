@@ -12,21 +12,28 @@ Note that all self.configrations for FaceGen are in self.config.py.
 
 import os
 import sys
+import time
 import torch
 import torch.optim as optim
 
 import numpy as np
 from torchvision import transforms
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, IterableDataset
 import util.custom_transforms as dt
 
 from model.model import Generator, Discriminator
+from model.compile import GeneratorLevels, DiscriminatorLevels
+from model.compile import enable_disk_cache
 
 import util.util as util
 from util.util import Phase
 from util.util import Gan
+from util.util import LoaderStats
+from util.prefetcher import DevicePrefetcher
 from util.replay import ReplayMemory
+from util.sampler import InfiniteSampler
 from util.snapshot import Snapshot
+from util.spectral_norm import set_power_iteration_cache
 
 import config
 from loss import FaceGenLoss
@@ -43,6 +50,7 @@ class FaceGen():
         transition_size : # of real images to show when fading in new layers
         mode : running mode {inpainting , generation}
         use_mask : flag for mask use in the model
+        batch_mask : mask maker for batches (None: masks made per sample)
         dataset_shape : input data shape
         use_cuda : flag for cuda use
         G : generator
@@ -51,6 +59,7 @@ class FaceGen():
         optim_D : optimizer for discriminator
         loss : losses of generator and discriminator
         replay_memory : replay memory
+        loader_stats : statistics of data loading
         global_it : global # of iterations through training
         global_cur_nimg : global # of current images through training
         snapshot : snapshot intermediate images, checkpoints, tensorboard logs
@@ -95,6 +104,28 @@ class FaceGen():
         self.mode = self.config.train.mode
         self.use_mask = self.config.train.use_mask
 
+        # uint8 images are normalized per batch on the device
+        self.batch_normalize = dt.BatchNormalize(0.5, 0.5)
+
+        # Masks made per batch on the device instead of per sample
+        self.batch_mask = None
+        if self.config.train.batch_mask:
+            self.batch_mask = dt.BatchPolygonMask(
+                self.config.dataset.num_classes)
+
+        # Augmentation of batches on the device
+        self.batch_augment = None
+        augment = self.config.train.augment
+        if augment.enabled:
+            # images are normalized first, so pad with normalized black
+            normalize = self.batch_normalize
+            self.batch_augment = dt.BatchScaleNRotate(
+                augment.rots, augment.scales, augment.image_mode,
+                fill=-normalize.mean / normalize.std)
+
+        # Real and synthesized batches through D in a single pass
+        self.fused_D = self.config.train.fused_D
+
         # Data Shape
         dataset_shape = [1, self.config.dataset.num_channels,
                          self.config.train.net.max_resolution,
@@ -121,6 +152,19 @@ class FaceGen():
                                leaky_relu=True,
                                instancenorm=True,
                                spectralnorm=spectralnorm)
+        # D is called several times a step with the same weights
+        set_power_iteration_cache(self.D, self.config.train.sn_step_cache)
+
+        # G and D of training forwards, compiled per level if enabled
+        # (losses use G and D, gradient penalties need double backward)
+        self.G_run, self.D_run = self.G, self.D
+        cc = self.config.compile
+        if cc.enabled:
+            enable_disk_cache(cc.cache_dir)
+            self.G_run = GeneratorLevels(self.G, backend=cc.backend,
+                                         mode=cc.mode)
+            self.D_run = DiscriminatorLevels(self.D, backend=cc.backend,
+                                             mode=cc.mode)
 
         self.register_on_gpu()
         self.create_optimizer()
@@ -135,6 +179,10 @@ class FaceGen():
                                           self.use_cuda,
                                           self.config.replay.enabled)
 
+        # Data Loading Statistics
+        self.loader_stats = LoaderStats()
+        self.sampler = None  # sampler of the training set of the layer
+
         self.global_it = 1
         self.global_cur_nimg = 1
 
@@ -188,10 +236,19 @@ class FaceGen():
 
             cur_time = datetime.datetime.now()
             print("Layer Training Time : ", cur_time - prev_time)
+            print("Data Loading Wait Time : %.3f sec (%.3f sec hidden)"
+                  % (self.loader_stats.total_data_time,
+                     self.loader_stats.total_hidden_time))
             prev_time = cur_time
+            self.loader_stats.reset()
             print("********** New Layer [%d x %d] : batch_size %d **********"
                   % (cur_resol, cur_resol, batch_size))
 
+            # graphs of lower resolutions are not used again
+            if self.config.compile.enabled:
+                self.G_run.release(R - min_resol + 1)
+                self.D_run.release(R - min_resol + 1)
+
             # Phase
             if R == min_resol:
                 phases = {Phase.training: [1, train_iter]}
@@ -211,8 +268,10 @@ class FaceGen():
             from_it = phases[phase][0]
             to_it = phases[phase][1]
 
+            sampler_state = None
             if self.snapshot.is_restored:
                 from_it = self.snapshot._it + 1
+                sampler_state = self.snapshot._sampler_state
                 self.snapshot.is_restored = False
 
             cur_nimg = from_it*batch_size
@@ -223,6 +282,9 @@ class FaceGen():
             if len(self.training_set) == 0:
                 print("DataLoding is failed")
                 return
+            if self.sampler is not None and sampler_state is not None:
+                # continue with the exact next sample of the checkpoint
+                self.sampler.load_state_dict(sampler_state)
             if self.config.replay.enabled:
                 self.replay_memory.reset(cur_resol)
 
@@ -236,45 +298,55 @@ class FaceGen():
             # Training Set
             replay_mode = False
 
-            while cur_it <= total_it:
-                for _, sample_batched in enumerate(self.training_set):
-
-                    if sample_batched['image'].shape[0] < batch_size:
-                        break
-
-                    if cur_it > total_it:
-                        break
+            prefetcher = None
+            batches = self.repeat_train_set()
+            if self.config.loader.device_prefetch > 0:
+                prefetcher = DevicePrefetcher(
+                    batches, self.stage_batch,
+                    self.config.loader.device_prefetch, self.use_cuda)
+                batches = iter(prefetcher)
 
-                    # trasnfer tansition to training
-                    if cur_it == to_it and cur_it < total_it:
-                        phase = Phase.training
-
-                    # calculate current level (from 1)
-
-                    if phase == Phase.transition:
-                        # transition [pref level, current level]
-                        cur_level = float(R - min_resol + float(cur_it/to_it))
-                    else:
-                        # training
-                        cur_level = float(R - min_resol + 1)
-
-                    self.real = sample_batched['image']
-                    self.real_mask = sample_batched['real_mask']
-                    self.obs = sample_batched['image']
-                    self.obs_mask = sample_batched['obs_mask']
-                    self.source_domain = sample_batched['gender']
-                    self.target_domain = sample_batched['fake_gender']
-
-                    cur_nimg = self.train_step(batch_size,
-                                               cur_it,
-                                               total_it,
-                                               phase,
-                                               cur_resol,
-                                               cur_level,
-                                               cur_nimg)
-                    cur_it += 1
-                    self.global_it += 1
-                    self.global_cur_nimg += 1
+            while cur_it <= total_it:
+                fetch_time = time.perf_counter()
+                sample_batched = next(batches)
+                self.loader_stats.update_data_time(time.perf_counter() -
+                                                   fetch_time)
+                if prefetcher is not None:
+                    self.loader_stats.update_hidden_time(
+                        prefetcher.hidden_time)
+                else:
+                    sample_batched = self.stage_batch(sample_batched)
+                if self.sampler is not None:
+                    self.sampler.advance(batch_size)
+
+                # trasnfer tansition to training
+                if cur_it == to_it and cur_it < total_it:
+                    phase = Phase.training
+
+                # calculate current level (from 1)
+
+                if phase == Phase.transition:
+                    # transition [pref level, current level]
+                    cur_level = float(R - min_resol + float(cur_it/to_it))
+                else:
+                    # training
+                    cur_level = float(R - min_resol + 1)
+
+                self.prepare_batch(sample_batched)
+
+                cur_nimg = self.train_step(batch_size,
+                                           cur_it,
+                                           total_it,
+                                           phase,
+                                           cur_resol,
+                                           cur_level,
+                                           cur_nimg)
+                cur_it += 1
+                self.global_it += 1
+                self.global_cur_nimg += 1
+
+            if prefetcher is not None:
+                prefetcher.close()
 
             # Replay Mode
             if self.config.replay.enabled:
@@ -328,8 +400,6 @@ class FaceGen():
             cur_nimg: updated # of images in the phase
 
         """
-        self.preprocess()
-
         # Training discriminator
         d_cnt = 0
         if d_cnt < self.D_repeats:
@@ -371,7 +441,9 @@ class FaceGen():
                                self.optim_G,
                                self.optim_D,
                                self.loss.g_losses,
-                               self.loss.d_losses)
+                               self.loss.d_losses,
+                               self.loader_stats,
+                               self.sampler)
         cur_nimg += batch_size
 
         return cur_nimg
@@ -383,8 +455,8 @@ class FaceGen():
             cur_level: progress indicator of progressive growing network
 
         """
-        self.cls_syn, self.pixel_cls_syn = self.D(self.syn,
-                                                  cur_level=cur_level)
+        self.cls_syn, self.pixel_cls_syn = self.D_run(self.syn,
+                                                      cur_level=cur_level)
 
     def forward_D(self, cur_level, detach=True, replay_mode=False):
         """Forward discriminator.
@@ -396,16 +468,47 @@ class FaceGen():
 
         """
         if replay_mode is False:
-            self.syn = self.G(self.obs,
-                              mask=self.obs_mask,
-                              cur_level=cur_level)
+            self.syn = self.G_run(self.obs,
+                                  mask=self.obs_mask,
+                                  cur_level=cur_level)
 
         # self.syn = util.normalize_min_max(self.syn)
-        self.cls_real, self.pixel_cls_real = self.D(self.real,
-                                                    cur_level=cur_level)
-        self.cls_syn, self.pixel_cls_syn = self.D(
-                self.syn.detach() if detach else self.syn,
-                cur_level=cur_level)
+        syn = self.syn.detach() if detach else self.syn
+        if self.fused_D:
+            self.cls_real, self.cls_syn, \
+                self.pixel_cls_real, self.pixel_cls_syn = \
+                self.forward_D_fused(self.real, syn, cur_level)
+            return
+
+        self.cls_real, self.pixel_cls_real = self.D_run(self.real,
+                                                        cur_level=cur_level)
+        self.cls_syn, self.pixel_cls_syn = self.D_run(syn,
+                                                      cur_level=cur_level)
+
+    def forward_D_fused(self, real, syn, cur_level):
+        """Forward discriminator once on real and synthesized batches.
+
+        D has only per-sample operations (instance norm, no batch
+        statistics), so the outputs of the concatenated batch are those of
+        separate passes, while spectral norm power iterations and kernel
+        launches are done once.
+
+        Args:
+            real: real batch
+            syn: synthesized batch
+            cur_level: progress indicator of progressive growing network
+
+        Return: tuple, (cls_real, cls_syn, pixel_cls_real, pixel_cls_syn)
+        """
+        num_real = real.size(0)
+        cls, pixel_cls = self.D_run(torch.cat([real, syn]),
+                                    cur_level=cur_level)
+        cls_real, cls_syn = cls[:num_real], cls[num_real:]
+        pixel_cls_real = pixel_cls_syn = None
+        if pixel_cls is not None:
+            pixel_cls_real = pixel_cls[:num_real]
+            pixel_cls_syn = pixel_cls[num_real:]
+        return cls_real, cls_syn, pixel_cls_real, pixel_cls_syn
 
     def backward_G(self, cur_level):
         """Backward generator."""
@@ -449,14 +552,38 @@ class FaceGen():
         self.loss.d_losses.d_loss.backward(retain_graph=retain_graph)
         self.optim_D.step()
 
-    def preprocess(self):
-        """Set input type to cuda or cpu according to gpu availability."""
-        self.real = util.tofloat(self.use_cuda, self.real)
-        self.real_mask = util.tofloat(self.use_cuda, self.real_mask)
-        self.obs = util.tofloat(self.use_cuda, self.obs)
-        self.obs_mask = util.tofloat(self.use_cuda, self.obs_mask)
-        self.source_domain = util.tofloat(self.use_cuda, self.source_domain)
-        self.target_domain = util.tofloat(self.use_cuda, self.target_domain)
+    def stage_batch(self, sample_batched):
+        """Convert a batch of the data loader into float inputs on device.
+
+        Args:
+            sample_batched: batch of samples from the data loader
+
+        Return: the converted batch
+        """
+        device = 'cuda' if self.use_cuda else 'cpu'
+        sample_batched = self.batch_normalize(sample_batched, device)
+        if self.batch_mask is not None:
+            sample_batched = self.batch_mask(sample_batched, device)
+        if self.batch_augment is not None:
+            sample_batched = self.batch_augment(sample_batched)
+        for key in ['real_mask', 'obs_mask', 'gender', 'fake_gender']:
+            sample_batched[key] = sample_batched[key].to(
+                device, non_blocking=True).float()
+        return sample_batched
+
+    def prepare_batch(self, sample_batched):
+        """Set inputs of a training step from a staged batch.
+
+        Args:
+            sample_batched: batch of samples converted by stage_batch
+
+        """
+        self.real = sample_batched['image']
+        self.real_mask = sample_batched['real_mask']
+        self.obs = sample_batched['image']
+        self.obs_mask = sample_batched['obs_mask']
+        self.source_domain = sample_batched['gender']
+        self.target_domain = sample_batched['fake_gender']
 
     def check_gpu(self):
         """Check gpu availability."""
@@ -481,21 +608,62 @@ class FaceGen():
 
         """
         num_classes = self.config.dataset.num_classes
-        transform_options = transforms.Compose([dt.Normalize(0.5, 0.5),
-                                                dt.PolygonMask(num_classes),
-                                                dt.ToTensor()])
+        # images and masks stay uint8 until prepare_batch
+        transform_list = []
+        if self.batch_mask is None:
+            transform_list.append(dt.PolygonMask(num_classes))
+        transform_list.append(dt.ToByteTensor())
+        transform_options = transforms.Compose(transform_list)
 
         dataset_func = self.config.dataset.func
         ds = self.config.dataset
+        source_resol = ds.source_resolution
         datasets = util.call_func_by_name(data_dir=ds.data_dir,
                                           resolution=resol,
                                           landmark_info_path=ds.landmark_path,
                                           identity_info_path=ds.identity_path,
                                           filtered_list=ds.filtering_path,
                                           transform=transform_options,
+                                          source_resolution=source_resol,
+                                          region_cache=ds.region_cache,
+                                          decode_threads=ds.decode_threads,
                                           func=dataset_func)
         # train_dataset & data loader
-        return DataLoader(datasets, batch_size, True)
+        ld = self.config.loader
+        # iterable datasets shuffle by themselves and cannot be sampled
+        self.sampler = None
+        if not isinstance(datasets, IterableDataset):
+            self.sampler = InfiniteSampler(datasets, seed=ld.seed)
+        loader_options = dict(batch_size=batch_size,
+                              sampler=self.sampler,
+                              num_workers=ld.num_workers,
+                              pin_memory=ld.pin_memory and self.use_cuda,
+                              drop_last=ld.drop_last,
+                              worker_init_fn=util.seed_worker)
+        if ld.num_workers > 0:
+            loader_options.update(prefetch_factor=ld.prefetch_factor,
+                                  persistent_workers=ld.persistent_workers)
+        return DataLoader(datasets, **loader_options)
+
+    def repeat_train_set(self):
+        """Iterate over batches of the training set endlessly.
+
+        Return: generator of batches
+        """
+        epoch = 0
+        while True:
+            # the infinite sampler never ends an epoch of the loader
+            if hasattr(self.training_set.dataset, 'set_epoch'):
+                self.training_set.dataset.set_epoch(epoch)
+            epoch += 1
+            num_batches = 0
+            for sample_batched in self.training_set:
+                num_batches += 1
+                yield sample_batched
+            # e.g. no shards for this rank, which would loop forever
+            if num_batches == 0:
+                raise RuntimeError('an epoch of the training set yielded '
+                                   'no batches')
 
     def create_optimizer(self):
         """Create optimizers of generator and discriminator."""
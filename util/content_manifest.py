@@ -0,0 +1,110 @@
+"""content_manifest.py.
+
+This module includes the ContentManifest class
+which records inputs processed by preprocessing tools
+(image_generator.py, csv_merger.py), so that re-runs process only new or
+changed inputs.
+
+It depends on the standard library only, so the tools can import it when
+they are run as scripts in this directory.
+"""
+
+import os
+import json
+
+CONTENT_MANIFEST_VERSION = 2
+
+
+def file_signature(path):
+    """Get the signature of a file or a directory.
+
+    Args:
+        path (str): path of a file or a directory.
+
+    Return: [size, mtime in nanoseconds]
+    """
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+class ContentManifest(object):
+    """Manifest of inputs processed by a preprocessing tool.
+
+    Entries map the key of an input (e.g. an identity) to the signature
+    the input had when it was processed, so later runs process only new or
+    changed inputs. Outputs written for an input can be recorded with it,
+    so they are known when the input changes or is removed. The manifest
+    is saved atomically, so an interrupted run resumes from the last save.
+
+    Attributes:
+        path : json path of the manifest
+        params : parameters of the tool, entries of other params are dropped
+        entries : {key: signature} of processed inputs
+        outputs : {key: [output path]} of processed inputs
+
+    """
+
+    def __init__(self, path, params=None):
+        """Load the manifest at path if it was made with the same params.
+
+        Args:
+            path (str): json path of the manifest.
+            params (dict): json serializable parameters of the tool.
+        """
+        self.path = path
+        self.params = params or {}
+        self.entries = {}
+        self.outputs = {}
+        if not os.path.exists(path):
+            return
+
+        with open(path) as f:
+            manifest = json.load(f)
+        if manifest.get('version') == CONTENT_MANIFEST_VERSION \
+           and manifest.get('params') == self.params:
+            self.entries = manifest['entries']
+            self.outputs = manifest['outputs']
+
+    def is_done(self, key, signature):
+        """Check whether an input was processed with the same signature."""
+        return self.entries.get(key) == signature
+
+    def mark_done(self, key, signature, outputs=None):
+        """Record an input as processed.
+
+        Args:
+            key (str): key of the input.
+            signature: signature of the input when it was processed.
+            outputs (list): paths written for the input, Default is None
+                            (not recorded).
+        """
+        self.entries[key] = signature
+        if outputs is None:
+            self.outputs.pop(key, None)
+        else:
+            self.outputs[key] = list(outputs)
+
+    def prune(self, keys):
+        """Drop entries of inputs which no longer exist.
+
+        Args:
+            keys (iterable): keys of existing inputs.
+
+        Return: {key: [output path]} of dropped entries.
+        """
+        dropped = {}
+        for key in set(self.entries) - set(keys):
+            del self.entries[key]
+            dropped[key] = self.outputs.pop(key, [])
+        return dropped
+
+    def save(self):
+        """Save the manifest, replacing the previous one atomically."""
+        manifest = {'version': CONTENT_MANIFEST_VERSION,
+                    'params': self.params,
+                    'entries': self.entries,
+                    'outputs': self.outputs}
+        tmp_path = self.path + f'.tmp-{os.getpid()}'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.path)
@@ -1,54 +1,171 @@
 """Merge CSVs in separate directories.
 
+Merged files are written as csv, or as typed columnar parquet files
+indexed by NAME_ID / filename when the save path ends with .parquet
+(requires pyarrow or fastparquet).
+
 python csv_merger.py
 """
 
 import os
 import glob
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 
 import pandas as pd
 
+try:
+    from util.content_manifest import ContentManifest, file_signature
+except ImportError:  # run as a script in util/
+    from content_manifest import ContentManifest, file_signature
+
+LANDMARK_FILE_NAME = 'loose_landmarks_256.csv'
+FILTERED_LIST_FILE_NAME = 'result.xlsx'
+
+
+def read_table(path):
+    """Read a merged csv or parquet file.
+
+    Args:
+        path (str): path of a .csv or .parquet file.
+
+    Return: DataFrame with the index of a parquet file as its first column.
+    """
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path).reset_index()
+    return pd.read_csv(path)
+
+
+def write_table(table, path, index_column, dtypes=None):
+    """Write a merged table to a csv or parquet file.
+
+    Floats of parquet files are stored as float32.
+
+    Args:
+        table (DataFrame): merged table.
+        path (str): path of a .csv or .parquet file.
+        index_column (str): column to index parquet files by.
+        dtypes (dict): {column: dtype} of parquet files, Default is None.
+    """
+    if not path.endswith('.parquet'):
+        table.to_csv(path, index=False)
+        return
+    floats = table.select_dtypes('float64').columns
+    table = table.astype({c: 'float32' for c in floats})
+    table = table.astype(dtypes or {}).set_index(index_column)
+    table.to_parquet(path)
+
 
 class CsvMerger(object):
-    """Merge CSV files in dirs class."""
+    """Merge CSV files in dirs class.
+
+    Each merged file has a manifest (<save path>.manifest.json) recording
+    the signature of every identity file merged into it. Re-runs keep the
+    rows of unchanged identities from the merged file and read only new or
+    changed identity files.
+    """
 
     def __init__(self,
                  data_dir,
                  landmark_save_path,
-                 filtered_list_save_path):
+                 filtered_list_save_path,
+                 num_workers=None):
         """constructor.
 
         Args:
             data_dir (str): Directory having raw datasets.
             landmark_save_path (str): Absolute path to save merged landmark
-                                      information.
+                                      information (.csv or .parquet).
             filtered_list_save_path (str): Absolute path to save merged
-                                           filtered list information.
+                                           filtered list information
+                                           (.csv or .parquet).
+            num_workers (int): The number of processes reading files,
+                               Default is None (the number of cpus).
         """
         self.landmark_save_path = landmark_save_path
         self.filtered_list_save_path = filtered_list_save_path
-        self.people_dirs = glob.glob(data_dir + '/n[0-9]*')
+        self.people_dirs = sorted(glob.glob(data_dir + '/n[0-9]*'))
+        self.num_workers = num_workers
 
     def save_merged_landmark(self):
         """Merge landmarks and save to csv."""
-        all_landmarks = pd.DataFrame([])
-        for d in self.people_dirs:
-            landmark = pd.read_csv(os.path.join(d, "loose_landmarks_256.csv"))
-            all_landmarks = all_landmarks.append(landmark)
-        all_landmarks.to_csv(self.landmark_save_path, index=False)
-        return
+        self.merge(self.landmark_save_path, LANDMARK_FILE_NAME,
+                   self.read_landmark, 'NAME_ID')
 
     def save_merged_filtered_list(self):
         """Merge filtered list and save to csv."""
-        all_filtered_list = pd.DataFrame([])
-        for d in self.people_dirs:
-            filtered_list = pd.read_excel(os.path.join(d, "result.xlsx"))
-            filtered_list['filename'] = filtered_list['filename'].\
-                apply(lambda x: os.path.basename(d)+'/'+x)
-            all_filtered_list = all_filtered_list.append(filtered_list)
-        all_filtered_list.to_csv(self.filtered_list_save_path, index=False)
-        return
+        self.merge(self.filtered_list_save_path, FILTERED_LIST_FILE_NAME,
+                   self.read_filtered_list, 'filename',
+                   dtypes={'category': 'category'})
+
+    def read_landmark(self, d):
+        """Read landmarks of an identity."""
+        return pd.read_csv(os.path.join(d, LANDMARK_FILE_NAME))
+
+    def read_filtered_list(self, d):
+        """Read filtered list of an identity."""
+        filtered_list = pd.read_excel(os.path.join(d, FILTERED_LIST_FILE_NAME))
+        filtered_list['filename'] = \
+            os.path.basename(d) + '/' + filtered_list['filename']
+        return filtered_list
+
+    def merge(self, save_path, file_name, read_func, key_column,
+              dtypes=None):
+        """Merge files of identities into a file, reading only the changes.
+
+        Files of identities are read in parallel and concatenated once.
+
+        Args:
+            save_path (str): path to save the merged csv or parquet file.
+            file_name (str): file name of an identity to merge.
+            read_func: function reading the file of an identity directory.
+            key_column (str): column starting with 'identity/', which
+                              indexes parquet files.
+            dtypes (dict): {column: dtype} of parquet files, Default is None.
+        """
+        # a merged csv changed by others is merged again from scratch
+        output_signature = None
+        if os.path.exists(save_path):
+            output_signature = file_signature(save_path)
+        manifest = ContentManifest(save_path + '.manifest.json',
+                                   params={'output': output_signature})
+
+        signatures = {os.path.basename(d):
+                      file_signature(os.path.join(d, file_name))
+                      for d in self.people_dirs}
+        removed = manifest.prune(signatures)
+        kept = {cls_id for cls_id, sig in signatures.items()
+                if manifest.is_done(cls_id, sig)}
+        todo = [d for d in self.people_dirs
+                if os.path.basename(d) not in kept]
+        print('%s: %d / %d identities to merge'
+              % (save_path, len(todo), len(self.people_dirs)))
+        if not todo and not removed:
+            return
+
+        merged = []
+        if kept:
+            prev = read_table(save_path)
+            cls_ids = prev[key_column].str.split('/').str[0]
+            merged.append(prev[cls_ids.isin(kept)])
+        if self.num_workers == 0:
+            merged.extend(map(read_func, todo))
+        else:
+            with ProcessPoolExecutor(self.num_workers) as pool:
+                merged.extend(pool.map(read_func, todo, chunksize=16))
+        merged = pd.concat(merged, ignore_index=True) if merged \
+            else pd.DataFrame([])
+
+        # the manifest is saved after the merged file, so an interrupted
+        # run merges its identities again
+        root, ext = os.path.splitext(save_path)
+        tmp_path = f'{root}.tmp-{os.getpid()}{ext}'
+        write_table(merged, tmp_path, key_column, dtypes)
+        os.replace(tmp_path, save_path)
+
+        manifest.entries = signatures
+        manifest.params = {'output': file_signature(save_path)}
+        manifest.save()
 
 
 if __name__ == "__main__":
@@ -62,11 +179,16 @@ if __name__ == "__main__":
     parser.add_argument("--filtered_list_save_path",
                         default="../dataset/VGGFACE2/train/all_filtered_results.csv",  # noqa: E501
                         help="Filtered results", type=str)
+    parser.add_argument("--num_workers",
+                        default=None,
+                        help="The number of processes, Default is # of cpus",
+                        type=int)
     args = parser.parse_args()
 
     merger = CsvMerger(args.data_dir,
                        args.landmark_save_path,
-                       args.filtered_list_save_path)
+                       args.filtered_list_save_path,
+                       args.num_workers)
 
     merger.save_merged_landmark()
     merger.save_merged_filtered_list()
@@ -5,11 +5,113 @@ import random
 import cv2
 import numpy as np
 import torch
+import torch.nn.functional as F
 
 """
 TODO: Scaling/Rotation makes values lower than -1 check
 """
 
+# landmark coordinates of the face-region polygon vertices
+POLYGON_LANDMARKS = [0, 1, 2, 3, 2, 3, 8, 9, 6, 7, 0, 1]
+NOSE_LANDMARKS = [4, 5]
+
+# polygon vertices
+EYE_LEFT = 0
+EYE_RIGHT = 1
+CHEEK_RIGHT = 2
+LIP_RIGHT = 3
+LIP_LEFT = 4
+CHEEK_LEFT = 5
+
+
+def face_polygons(landmarks):
+    """Compute face-region polygons from landmarks.
+
+    Works on both numpy arrays and torch tensors.
+
+    Args:
+        landmarks: [N, 10] integer landmarks on 256x256 images.
+
+    Returns:
+        polygons: [N, 6, 2] integer polygon vertices on 256x256 images.
+
+    """
+    polygons = landmarks[:, POLYGON_LANDMARKS].reshape(-1, 6, 2)
+    nose = landmarks[:, NOSE_LANDMARKS]
+
+    # eye mask width
+    eye_width = abs(polygons[:, EYE_LEFT, 0] - nose[:, 0])
+    polygons[:, EYE_LEFT, 0] -= eye_width
+    eye_width = abs(polygons[:, EYE_RIGHT, 0] - nose[:, 0])
+    polygons[:, EYE_RIGHT, 0] += eye_width
+
+    # eye mask height
+    eye_height = abs(polygons[:, EYE_LEFT, 1] - nose[:, 1])//2
+    polygons[:, EYE_LEFT, 1] -= eye_height
+    eye_height = abs(polygons[:, EYE_RIGHT, 1] - nose[:, 1])//2
+    polygons[:, EYE_RIGHT, 1] -= eye_height
+
+    # cheek mask width
+    polygons[:, CHEEK_LEFT, 0] = polygons[:, EYE_LEFT, 0]
+    polygons[:, CHEEK_RIGHT, 0] = polygons[:, EYE_RIGHT, 0]
+
+    # cheek mask height
+    polygons[:, CHEEK_LEFT, 1] = nose[:, 1]
+    polygons[:, CHEEK_RIGHT, 1] = nose[:, 1]
+
+    # lip mask height
+    lip_height = abs(polygons[:, LIP_LEFT, 1] - nose[:, 1])//2
+    polygons[:, LIP_LEFT, 1] += lip_height
+    lip_height = abs(polygons[:, LIP_RIGHT, 1] - nose[:, 1])//2
+    polygons[:, LIP_RIGHT, 1] += lip_height
+
+    return polygons
+
+
+def fill_polygons(polygons, height, width):
+    """Rasterize polygons on a pixel grid.
+
+    A pixel is filled if it is inside a polygon (even-odd rule) or within
+    half a pixel of an edge along the edge's minor axis, as edges are drawn
+    by cv2.fillPoly. The result matches cv2.fillPoly up to ties on edges.
+
+    Args:
+        polygons (tensor): [N, V, 2] integer polygon vertices in pixels.
+        height (int): height of the grid.
+        width (int): width of the grid.
+
+    Returns:
+        region (tensor): [N, height, width] bool, filled pixels.
+
+    """
+    N, V, _ = polygons.shape
+    polygons = polygons.float()
+    x0 = polygons[:, :, 0].view(N, V, 1, 1)
+    y0 = polygons[:, :, 1].view(N, V, 1, 1)
+    x1 = polygons[:, :, 0].roll(-1, dims=1).view(N, V, 1, 1)
+    y1 = polygons[:, :, 1].roll(-1, dims=1).view(N, V, 1, 1)
+
+    px = torch.arange(width, device=polygons.device,
+                      dtype=torch.float32).view(1, 1, 1, width)
+    py = torch.arange(height, device=polygons.device,
+                      dtype=torch.float32).view(1, 1, height, 1)
+
+    # even-odd rule: count edges crossed by a ray to the right of a pixel
+    straddle = (y0 > py) != (y1 > py)
+    x_cross = (x1 - x0) * (py - y0) / torch.where(straddle, y1 - y0,
+                                                  torch.ones_like(y0)) + x0
+    inside = (straddle & (px < x_cross)).sum(dim=1) % 2 == 1
+
+    # pixels on edges
+    dx, dy = x1 - x0, y1 - y0
+    major = torch.max(dx.abs(), dy.abs()).clamp(min=1)
+    on_line = (dx * (py - y0) - dy * (px - x0)).abs() <= 0.5 * major
+    in_box = (torch.min(x0, x1) <= px) & (px <= torch.max(x0, x1)) & \
+             (torch.min(y0, y1) <= py) & (py <= torch.max(y0, y1))
+    on_edge = (on_line & in_box).any(dim=1)
+
+    return inside | on_edge
+
 
 class ScaleNRotate(object):
     """Scale (zoom-in, zoom-out) and Rotate the image and the ground truth."""
@@ -64,6 +166,81 @@ class ScaleNRotate(object):
         return f'ScaleNRotate:(rot={str(self.rots)},scale={str(self.scales)})'
 
 
+class BatchScaleNRotate(object):
+    """Scale and Rotate images and masks of a batch.
+
+    Same augmentation as ScaleNRotate with a random angle and scale per
+    sample, warping a whole batch with one affine_grid/grid_sample call.
+    Images are interpolated by image_mode and masks by nearest. Pixels
+    outside the input are filled with fill in images and 0 in masks.
+    """
+
+    def __init__(self, rots=(-30, 30), scales=(.75, 1.25),
+                 image_mode='bilinear', fill=0.):
+        """constructor.
+
+        Args:
+            rots (tuple): (minimum, maximum) rotation angle in degrees.
+            scales (tuple): (minimum, maximum) scale.
+            image_mode (str): interpolation of images {bilinear, bicubic}.
+            fill (float): value of images outside the input, e.g. black
+                          of normalized images, Default is 0.
+        """
+        assert image_mode in ('bilinear', 'bicubic')
+        self.rots = rots
+        self.scales = scales
+        self.image_mode = image_mode
+        self.fill = fill
+
+    def __call__(self, sample):
+        """caller.
+
+        Args:
+            sample (dict): {str: tensor} batch of samples having float
+                           'image' [N, C, H, W] and optionally
+                           'real_mask', 'obs_mask' [N, 1, H, W].
+
+        Returns:
+            sample (dict): {str: tensor} batch with warped images and masks.
+
+        """
+        image = sample['image']
+        N, _, H, W = image.shape
+        device = image.device
+
+        rot = torch.empty(N, device=device).uniform_(*self.rots)
+        rot = torch.deg2rad(rot)
+        sc = torch.empty(N, device=device).uniform_(*self.scales)
+
+        # inverse of cv2.getRotationMatrix2D in normalized coordinates,
+        # mapping output coordinates to input coordinates
+        cos, sin = torch.cos(rot) / sc, torch.sin(rot) / sc
+        zero = torch.zeros_like(cos)
+        theta = torch.stack([torch.stack([cos, -sin * H / W, zero], 1),
+                             torch.stack([sin * W / H, cos, zero], 1)], 1)
+        grid = F.affine_grid(theta, image.shape, align_corners=False)
+
+        # grid_sample pads zeros, so warp the offset from fill
+        image = F.grid_sample(image - self.fill, grid, mode=self.image_mode,
+                              align_corners=False)
+        sample['image'] = image.add_(self.fill)
+
+        masks = [elem for elem in ['real_mask', 'obs_mask'] if elem in sample]
+        if masks:
+            stacked = torch.cat([sample[elem].to(device).float()
+                                 for elem in masks], 1)
+            stacked = F.grid_sample(stacked, grid, mode='nearest',
+                                    align_corners=False)
+            for elem, mask in zip(masks, stacked.split(1, 1)):
+                sample[elem] = mask
+        return sample
+
+    def __str__(self):  # noqa: D105
+        return f'BatchScaleNRotate:(rot={str(self.rots)},' \
+               f'scale={str(self.scales)},mode={self.image_mode},' \
+               f'fill={self.fill})'
+
+
 class ToTensor(object):
     """Convert ndarrays in sample to Tensors."""
 
@@ -78,6 +255,8 @@ class ToTensor(object):
 
         """
         for elem in ['image', 'real_mask', 'obs_mask']:
+            if elem not in sample:  # masks are made for batches
+                continue
             tmp = sample[elem]
 
             if tmp.ndim == 2:
@@ -92,6 +271,39 @@ class ToTensor(object):
         return sample
 
 
+class ToByteTensor(object):
+    """Convert uint8 ndarrays in sample to uint8 Tensors without copying.
+
+    Images and masks stay uint8 through collate and are normalized as a
+    batch on the training device by BatchNormalize.
+    """
+
+    def __call__(self, sample):
+        """caller.
+
+        Args:
+            sample (dict): {str: array} formatted data for training.
+
+        Returns:
+            sample (dict): {str: array} formatted data for training.
+
+        """
+        for elem in ['image', 'real_mask', 'obs_mask']:
+            if elem not in sample:  # masks are made for batches
+                continue
+            tmp = sample[elem]
+
+            if tmp.ndim == 2:
+                tmp = tmp[:, :, np.newaxis]
+            if not tmp.flags.writeable:  # e.g. memory-mapped images
+                tmp = tmp.copy()
+
+            # H x W x C view as C x H x W
+            sample[elem] = torch.from_numpy(tmp).permute(2, 0, 1)
+
+        return sample
+
+
 class Normalize(object):
     """Normalize a tensor image with mean and standard deviation."""
 
@@ -128,6 +340,49 @@ class Normalize(object):
                 format(self.mean, self.std)
 
 
+class BatchNormalize(object):
+    """Normalize a batch of images on the device of the batch.
+
+    uint8 images are scaled to [0, 1] and normalized in one pass,
+    other images are only normalized.
+    """
+
+    def __init__(self, mean, std):
+        """constructor.
+
+        Args:
+            mean (float): mean value of an image.
+            std (float): standard deviation value of an image.
+        """
+        self.mean = mean
+        self.std = std
+
+    def __call__(self, sample, device=None):
+        """caller.
+
+        Args:
+            sample (dict): {str: tensor} batch of samples having
+                           'image' [N, C, H, W].
+            device: device to normalize on, Default is the image device.
+
+        Returns:
+            sample (dict): {str: tensor} batch with float 'image'.
+
+        """
+        image = sample['image']
+        device = image.device if device is None else device
+        scale = 1. / self.std
+        if image.dtype == torch.uint8:
+            scale /= 255.
+        image = image.to(device, non_blocking=True).float()
+        sample['image'] = image.mul_(scale).sub_(self.mean / self.std)
+        return sample
+
+    def __str__(self):  # noqa: D105
+        return self.__class__.__name__ + '(mean={0}, std={1})'.\
+                format(self.mean, self.std)
+
+
 class PolygonMask(object):
     """Add Square mask to the sample."""
 
@@ -154,59 +409,24 @@ class PolygonMask(object):
         landmark_adjust_ratio = 256 // resolution
         real_mask = np.full([resolution, resolution], gender,
                             dtype=np.uint8)
-        obs_mask = real_mask.copy()
-
-        polygon_coords = np.take(landmark,
-                                 [0, 1, 2, 3, 2, 3, 8, 9, 6, 7, 0, 1])
-        nose_coords = np.take(landmark, [4, 5])
-
-        polygon_coords = polygon_coords.astype(np.int32).reshape(1, -1, 2)
-        nose_coords = nose_coords.astype(np.int32).reshape(1, -1, 2)
-
-        # eye mask width
-        EYE_LEFT = 0
-        EYE_RIGHT = 1
-        eye_width = abs(polygon_coords[:, EYE_LEFT, 0]
-                        - nose_coords[:, 0, 0]).astype(np.int32)
-        polygon_coords[:, EYE_LEFT, 0] -= eye_width
-        eye_width = abs(polygon_coords[:, EYE_RIGHT, 0]
-                        - nose_coords[:, 0, 0]).astype(np.int32)
-        polygon_coords[:, EYE_RIGHT, 0] += eye_width
-
-        # eye mask height
-        eye_height = abs(polygon_coords[:, EYE_LEFT, 1]
-                         - nose_coords[:, 0, 1]).astype(np.int32)//2
-        polygon_coords[:, EYE_LEFT, 1] -= eye_height
-        eye_height = abs(polygon_coords[:, EYE_RIGHT, 1]
-                         - nose_coords[:, 0, 1]).astype(np.int32)//2
-        polygon_coords[:, EYE_RIGHT, 1] -= eye_height
 
-        # cheek mask width
-        CHEEK_LEFT = 5
-        CHEEK_RIGHT = 2
-        polygon_coords[:, CHEEK_LEFT, 0] = polygon_coords[:, EYE_LEFT, 0]
-        polygon_coords[:, CHEEK_RIGHT, 0] = polygon_coords[:, EYE_RIGHT, 0]
-
-        # cheek mask height
-        polygon_coords[:, CHEEK_LEFT, 1] = nose_coords[:, 0, 1]
-        polygon_coords[:, CHEEK_RIGHT, 1] = nose_coords[:, 0, 1]
-
-        # lip mask width
-        LIP_LEFT = 4
-        LIP_RIGHT = 3
-
-        # lip mask height
-        lip_height = abs(polygon_coords[:, LIP_LEFT, 1]
-                         - nose_coords[:, 0, 1]).astype(np.int32)//2
-        polygon_coords[:, LIP_LEFT, 1] += lip_height
-        lip_height = abs(polygon_coords[:, LIP_RIGHT, 1]
-                         - nose_coords[:, 0, 1]).astype(np.int32)//2
-        polygon_coords[:, LIP_RIGHT, 1] += lip_height
+        region = sample.get('region')
+        if region is not None and region.shape == real_mask.shape:
+            # face region rasterized once in the dataset manifest
+            obs_mask = np.where(region, fake_gender, real_mask)
+            obs_mask = obs_mask.astype(np.uint8)
+        else:
+            if 'polygon' in sample:
+                polygon_coords = np.asarray(sample['polygon'],
+                                            dtype=np.int32).reshape(1, -1, 2)
+            else:
+                landmark = np.asarray(landmark).reshape(1, -1)
+                polygon_coords = face_polygons(landmark.astype(np.int32))
+            polygon_coords = polygon_coords // landmark_adjust_ratio
 
-        polygon_coords = polygon_coords // landmark_adjust_ratio
-
-        cv2.fillPoly(real_mask, polygon_coords, int(gender))
-        cv2.fillPoly(obs_mask, polygon_coords, fake_gender)
+            # the real mask is filled with gender everywhere
+            obs_mask = real_mask.copy()
+            cv2.fillPoly(obs_mask, polygon_coords, fake_gender)
 
         assert len(image.shape) == 3, \
             f'image dims should be 3, not {len(image.shape)}'
@@ -290,3 +510,62 @@ class PolygonMask(object):
 
     def __str__(self):  # noqa: D105
         return f'PolygonMask:(num_classes={str(self.num_classes)})'
+
+
+class BatchPolygonMask(object):
+    """Add polygon masks to a batch of samples.
+
+    Same masks as PolygonMask, computed for a whole batch at once with
+    tensor operations on the device of the batch.
+    """
+
+    def __init__(self, num_classes=10):
+        """constructor."""
+        self.num_classes = num_classes
+
+    def __call__(self, sample, device=None):
+        """caller.
+
+        Args:
+            sample (dict): {str: tensor} batch of samples having
+                           'image' [N, C, H, W], 'landmark' [N, 10] and
+                           'gender' [N]. Precomputed 'polygon' [N, 6, 2]
+                           or 'region' [N, H, W] are used when present.
+            device: device to make masks on, Default is the image device.
+
+        Returns:
+            sample (dict): {str: tensor} batch with 'real_mask',
+                           'obs_mask' [N, 1, H, W] and 'fake_gender' [N].
+
+        """
+        image = sample['image']
+        device = image.device if device is None else device
+        gender = sample['gender'].to(device)
+
+        N, _, H, W = image.shape
+        fake_gender = torch.randint(1, 3, (N,), device=device)
+
+        region = sample.get('region')
+        if region is not None and tuple(region.shape[-2:]) == (H, W):
+            region = region.to(device).bool().view(N, 1, H, W)
+        else:
+            if 'polygon' in sample:
+                polygons = sample['polygon'].to(device).long()
+            else:
+                polygons = face_polygons(sample['landmark'].to(device).long())
+            polygons = polygons // (256 // H)
+            region = fill_polygons(polygons, H, W).unsqueeze(1)
+
+        gender = gender.view(N, 1, 1, 1).float()
+        real_mask = gender.expand(N, 1, H, W).contiguous()
+        obs_mask = torch.where(region,
+                               fake_gender.view(N, 1, 1, 1).float(),
+                               gender)
+
+        sample['real_mask'] = real_mask
+        sample['obs_mask'] = obs_mask
+        sample['fake_gender'] = fake_gender
+        return sample
+
+    def __str__(self):  # noqa: D105
+        return f'BatchPolygonMask:(num_classes={str(self.num_classes)})'
@@ -11,25 +11,126 @@ Directory structure:
                 - 4
                 - 8
                 - ...
+                - .manifest
+                - packed
                 - all_filtered_results.csv
                 - all_loose_landmarks_256.csv
             - identity_info.csv
+        - CelebA-HQ
+            - celeba-hq-r02.tfrecords
+            - celeba-hq-r02.tfrecords.index.npz
+            - ...
 """
 
 import os
-import re
 import glob
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
-import pandas as pd
+import torch.distributed as dist
 from PIL import Image
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 
+from util.content_manifest import file_signature
+from util.manifest import DatasetManifest, PathList
+from util.shard_packer import PACK_DIR_NAME, load_packed, shard_names
+from util.tfrecord import index_tfrecord, parse_example, read_record_at
 
-class CelebADataset(Dataset):
+
+def area_downsample(image_arr, resolution):
+    """Downsample an image by averaging square areas.
+
+    Args:
+        image_arr (array): [H, W, C] uint8 image, H and W are multiples of
+                           resolution.
+        resolution (int): target resolution.
+
+    Return: [resolution, resolution, C] uint8 image.
+    """
+    h, w, c = image_arr.shape
+    fh, fw = h // resolution, w // resolution
+    area = image_arr.reshape(resolution, fh, resolution, fw, c)\
+                    .sum(axis=(1, 3), dtype=np.uint32)
+    return ((area + fh*fw // 2) // (fh*fw)).astype(np.uint8)
+
+
+class ThreadedDecodeMixin(object):
+    """Decode the samples of a minibatch with a thread pool.
+
+    DataLoader fetches a whole minibatch through __getitems__, and image
+    decoding releases the GIL, so a single worker process decodes
+    decode_threads images at once.
+    """
+
+    decode_threads = 0
+
+    def __getitems__(self, indices):
+        """Get the samples of a minibatch.
+
+        Args:
+            indices (list): indices of image list.
+
+        Return: list of samples.
+        """
+        if self.decode_threads <= 1:
+            return [self[idx] for idx in indices]
+        return list(self.decode_pool().map(self.__getitem__, indices))
+
+    def decode_pool(self):
+        """Get the thread pool of the current process."""
+        # threads do not survive fork, so each worker makes its own pool
+        if getattr(self, 'pool_pid', None) != os.getpid():
+            self.pool = ThreadPoolExecutor(self.decode_threads)
+            self.pool_pid = os.getpid()
+        return self.pool
+
+    def __getstate__(self):
+        """Get the state to pickle, without the thread pool."""
+        state = self.__dict__.copy()
+        state.pop('pool', None)
+        state.pop('pool_pid', None)
+        return state
+
+
+class VGGFace2MetadataMixin(object):
+    """Metadata of VGGFace2 samples from per-sample arrays of a manifest.
+
+    Attributes:
+        resolution : resolution of samples
+        landmarks : [N, 10] landmarks
+        genders : [N] genders
+        polygons : [N, 6, 2] mask polygons
+        regions : bit-packed face regions, None without the region cache
+        region_rows : rows of samples in regions
+
+    """
+
+    def metadata(self, idx):
+        """Get metadata of a sample.
+
+        Args:
+            idx (int): index of the sample in the dataset.
+
+        Return:
+            sample (dict): {str: array} landmark, gender, mask polygon and
+                           optionally face region.
+        """
+        sample = {'landmark': self.landmarks[idx],
+                  'gender': int(self.genders[idx]),
+                  'polygon': self.polygons[idx]}
+        if self.regions is not None:
+            res = self.resolution
+            region = np.unpackbits(self.regions[self.region_rows[idx]],
+                                   count=res*res)
+            sample['region'] = region.reshape(res, res)
+        return sample
+
+
+class CelebADataset(ThreadedDecodeMixin, Dataset):
     """CelebA Dataset according to the resolution."""
 
-    def __init__(self, data_dir, resolution, transform=None):
+    def __init__(self, data_dir, resolution, transform=None,
+                 decode_threads=0):
         """Constructor.
 
         Args:
@@ -40,9 +141,12 @@ class CelebADataset(Dataset):
                                 transform.CenterCrop(10),
                                 transform.ToTensor(),
                                 ]))
+            decode_threads (int): The number of threads decoding a
+                                  minibatch, Default is 0 (no threads).
         """
-        self.file_list = glob.glob(data_dir + f'{resolution}/*.jpg')
+        self.file_list = PathList(glob.glob(data_dir + f'{resolution}/*.jpg'))
         self.transform = transform
+        self.decode_threads = decode_threads
 
     def __getitem__(self, idx):
         """Getter.
@@ -66,10 +170,11 @@ class CelebADataset(Dataset):
         return len(self.file_list)
 
 
-class CelebAHQDataset(Dataset):
+class CelebAHQDataset(ThreadedDecodeMixin, Dataset):
     """CelebA-HQ Dataset according to the resolution."""
 
-    def __init__(self, data_dir, resolution, transform=None):
+    def __init__(self, data_dir, resolution, transform=None,
+                 decode_threads=0):
         """Constructor.
 
         Args:
@@ -80,9 +185,12 @@ class CelebAHQDataset(Dataset):
                                 transform.CenterCrop(10),
                                 transform.ToTensor(),
                                 ]))
+            decode_threads (int): The number of threads decoding a
+                                  minibatch, Default is 0 (no threads).
         """
-        self.file_list = glob.glob(data_dir + f'{resolution}/*.png')
+        self.file_list = PathList(glob.glob(data_dir + f'{resolution}/*.png'))
         self.transform = transform
+        self.decode_threads = decode_threads
 
     def __getitem__(self, idx):
         """Getter.
@@ -108,12 +216,109 @@ class CelebAHQDataset(Dataset):
         return len(self.file_list)
 
 
-class VGGFace2Dataset(Dataset):
+class TFRecordCelebAHQDataset(ThreadedDecodeMixin, Dataset):
+    """CelebA-HQ Dataset read directly from the tfrecord of a resolution.
+
+    The tfrecord of a resolution (<data_dir>/*-r<log2 resolution>.tfrecords)
+    is indexed once, the (offset, length) of its records are cached next to
+    it, and samples are read by seeking to their records, so the tfrecords
+    need no extraction. Samples are the same as CelebAHQDataset.
+    """
+
+    def __init__(self, data_dir, resolution, transform=None,
+                 decode_threads=0):
+        """Constructor.
+
+        Args:
+            data_dir (str): Directory path containing tfrecord files.
+            resolution (int): Specific resolution value to load.
+            transform: Augmentation options, Default is None.
+            decode_threads (int): The number of threads decoding a
+                                  minibatch, Default is 0 (no threads).
+        """
+        lod = int(np.log2(resolution))
+        tfr_files = glob.glob(os.path.join(data_dir,
+                                           f'*-r{lod:02d}.tfrecords'))
+        assert len(tfr_files) == 1, \
+            f'expected one tfrecord of {resolution}, found {tfr_files}'
+        self.tfr_file = tfr_files[0]
+        self.index = self.load_index(self.tfr_file)
+        self.transform = transform
+        self.decode_threads = decode_threads
+
+    def load_index(self, tfr_file):
+        """Load the record index of a tfrecord file, building it once.
+
+        Args:
+            tfr_file (str): tfrecord file path.
+
+        Return: [N, 2] (offset, length) of records
+        """
+        index_path = tfr_file + '.index.npz'
+        signature = np.array(file_signature(tfr_file), dtype=np.int64)
+        if os.path.exists(index_path):
+            cached = np.load(index_path)
+            if np.array_equal(cached['signature'], signature):
+                return cached['index']
+
+        index = index_tfrecord(tfr_file)
+        try:
+            np.savez(index_path + f'.tmp-{os.getpid()}.npz',
+                     index=index, signature=signature)
+            os.replace(index_path + f'.tmp-{os.getpid()}.npz', index_path)
+        except OSError as e:
+            print('Index is not saved: %s' % e)
+        return index
+
+    def file_descriptor(self):
+        """Get the file descriptor of the current process."""
+        # descriptors are not shared with forked workers
+        if getattr(self, 'fd_pid', None) != os.getpid():
+            self.fd = os.open(self.tfr_file, os.O_RDONLY)
+            self.fd_pid = os.getpid()
+        return self.fd
+
+    def __getitem__(self, idx):
+        """Getter.
+
+        Args:
+            idx (int): index of records.
+
+        Return:
+            sample (dict): {str: array} formatted data for training.
+        """
+        offset, length = self.index[idx]
+        record = read_record_at(self.file_descriptor(), int(offset),
+                                int(length))
+        ex = parse_example(record)
+        image_arr = np.frombuffer(ex['data'][0], np.uint8)\
+                      .reshape(ex['shape'])[:3]
+        image_arr = np.ascontiguousarray(image_arr.transpose(1, 2, 0))
+        attr_arr = np.frombuffer(ex['attr'][0], np.uint8).astype(np.int64)
+
+        sample = {'image': image_arr, 'attr': attr_arr}
+        if self.transform is not None:
+            sample = self.transform(sample)
+        return sample
+
+    def __getstate__(self):
+        """Get the state to pickle, without the file descriptor."""
+        state = super().__getstate__()
+        state.pop('fd', None)
+        state.pop('fd_pid', None)
+        return state
+
+    def __len__(self):  # noqa: D105
+        return len(self.index)
+
+
+class VGGFace2Dataset(VGGFace2MetadataMixin, ThreadedDecodeMixin, Dataset):
     """VGGFace2 Dataset according to the resolution."""
 
     def __init__(self, data_dir, resolution, landmark_info_path,
                  identity_info_path, filtered_list, use_low_res=False,
-                 transform=None):
+                 transform=None, source_resolution=None,
+                 region_cache=False, decode_threads=0):
         """Constructor.
 
         Args:
@@ -129,39 +334,37 @@ class VGGFace2Dataset(Dataset):
                                 transform.CenterCrop(10),
                                 transform.ToTensor(),
                                 ]))
+            source_resolution (int): Resolution of images to read, which are
+                                     downsampled to resolution. Default is
+                                     None (read images of resolution).
+            region_cache (bool): Add face regions rasterized once in the
+                                 manifest to samples, Default is False.
+            decode_threads (int): The number of threads decoding a
+                                  minibatch, Default is 0 (no threads).
         """
-        file_list = []
-        dir_list = os.listdir(os.path.join(data_dir, str(resolution)))
-        filtered_list = pd.read_csv(filtered_list)
-        if use_low_res:
-            good_list = filtered_list[filtered_list['category'] !=
-                                      'Removed']['filename']
-        else:
-            good_list = filtered_list[filtered_list['category'] ==
-                                      'Good']['filename']
-
-        for ext in ('*.gif', '*.png', '*.jpg'):
-            full_path = os.path.normcase(data_dir + f'/{resolution}/*/' + ext)
-            file_list.extend(glob.glob(full_path))
-
-        self.file_list = [i for i in file_list if
-                          good_list.str.contains(os.path.basename(i)).any()]
-
-        landmark_info = pd.read_csv(landmark_info_path)
-        landmark_info = landmark_info[landmark_info['NAME_ID']
-                                      .str.contains('|'.join(dir_list))]
-        identity_info = pd.read_csv(identity_info_path)
-        identity_info = identity_info[identity_info['Class_ID']
-                                      .str.contains('|'.join(dir_list))]
-        identity_info[' Gender'] = identity_info[' Gender'].apply(
-            lambda x: 2 if x == ' f' else 1)
-
-        self.landmark_info = landmark_info
-        self.identity_info = identity_info
-
-        self.cls_to_gender = identity_info.set_index('Class_ID')[' Gender']\
-                                          .to_dict()
+        # file list, landmarks and genders are shared by every resolution
+        # through the manifest cached next to the dataset, and are kept in
+        # flat arrays which forked workers do not copy on write
+        manifest = DatasetManifest(data_dir, landmark_info_path,
+                                   identity_info_path, filtered_list)
+        self.resolution = resolution
+        self.source_resolution = source_resolution or resolution
+        assert self.source_resolution >= resolution
+        indices = manifest.select(self.source_resolution, use_low_res)
+
+        self.keys = np.asarray(manifest.keys[indices])
+        self.file_list = manifest.paths(self.source_resolution, indices)
+        self.landmarks = np.ascontiguousarray(manifest.landmarks[indices])
+        self.genders = np.ascontiguousarray(manifest.genders[indices])
+        self.polygons = np.ascontiguousarray(manifest.polygons[indices])
+
+        # bit-packed regions stay memory-mapped, rows are looked up per item
+        self.regions = None
+        self.region_rows = indices
+        if region_cache:
+            self.regions = manifest.regions(resolution)
         self.transform = transform
+        self.decode_threads = decode_threads
 
     def __getitem__(self, idx):
         """Getter.
@@ -172,23 +375,303 @@ class VGGFace2Dataset(Dataset):
         Return:
             sample (dict): {str: array} formatted data for training.
         """
-        pattern = re.compile('n[0-9]{6}/[0-9]{4}_[0-9]{2}')
-        image_path = self.file_list[idx]
-        # For Windows OS
-        image_path = image_path.replace("\\", "/")
-        name_id = re.search(pattern, image_path)[0]
+        image_arr = self.read_image(self.file_list[idx])
 
-        cls_id = name_id.split('/')[0]
-        gender = int(self.cls_to_gender[cls_id])
-
-        landmark = self.landmark_info[self.landmark_info['NAME_ID'] ==
-                                      name_id].iloc[:, 2:].values.flatten()
-        image_arr = np.array(Image.open(image_path))
-
-        sample = {'image': image_arr, 'landmark': landmark, 'gender': gender}
+        sample = self.metadata(idx)
+        sample['image'] = image_arr
         if self.transform is not None:
             sample = self.transform(sample)
         return sample
 
+    def read_image(self, image_path):
+        """Read an image at the resolution of the dataset.
+
+        Args:
+            image_path (str): path of an image of source_resolution.
+
+        Return: [resolution, resolution, C] uint8 image.
+        """
+        img = Image.open(image_path)
+        if self.source_resolution != self.resolution:
+            size = (self.resolution, self.resolution)
+            # JPEG is decoded at a reduced scale (1/2, 1/4 or 1/8) not
+            # smaller than size, and the rest is area downsampled.
+            img.draft(img.mode, size)
+            img = img.resize(size, Image.BOX)
+        return np.array(img)
+
     def __len__(self):  # noqa: D105
         return len(self.file_list)
+
+
+class PackedVGGFace2Dataset(VGGFace2Dataset):
+    """VGGFace2 Dataset served from packed per-resolution arrays.
+
+    Images are read from <data_dir>/packed/<resolution>.npy built by
+    util/shard_packer.py instead of being decoded one file at a time.
+    """
+
+    def __init__(self, data_dir, resolution, landmark_info_path,
+                 identity_info_path, filtered_list, use_low_res=False,
+                 transform=None, source_resolution=None,
+                 region_cache=False, decode_threads=0):
+        """Constructor.
+
+        Args:
+            data_dir (str): Directory path containing dataset.
+            resolution (int): Specific resolution value to load.
+            landmark_info (str): Path of the file having landmark information.
+            identity_info (str): Path of the file having identity information.
+            filtered_list (str): Path of the file having filtered list
+                                 information.
+            use_low_res (bool): Use low resolution images or not.
+            transform: Augmentation options, Default is None.
+            source_resolution (int): Resolution of the packed array to read,
+                                     which is downsampled to resolution.
+                                     Default is None (resolution).
+            region_cache (bool): Add face regions rasterized once in the
+                                 manifest to samples, Default is False.
+            decode_threads (int): The number of threads reading a
+                                  minibatch, Default is 0 (no threads).
+        """
+        super().__init__(data_dir, resolution, landmark_info_path,
+                         identity_info_path, filtered_list, use_low_res,
+                         transform, source_resolution, region_cache,
+                         decode_threads)
+        self.images, packed_keys = load_packed(
+            os.path.join(data_dir, PACK_DIR_NAME), self.source_resolution)
+
+        # rows of the packed array, packed keys are sorted except for packs
+        # in record order (tfrecord_extractor.py)
+        order = None
+        if np.any(packed_keys[1:] < packed_keys[:-1]):
+            order = np.argsort(packed_keys, kind='stable')
+            packed_keys = packed_keys[order]
+        rows = np.searchsorted(packed_keys, self.keys)
+        rows = np.minimum(rows, len(packed_keys) - 1)
+        found = packed_keys[rows] == self.keys if len(packed_keys) \
+            else np.zeros(len(self.keys), dtype=bool)
+        if order is not None:
+            rows = order[rows]
+
+        self.rows = rows[found]
+        self.keys = self.keys[found]
+        self.file_list = self.file_list.take(np.flatnonzero(found))
+        self.landmarks = self.landmarks[found]
+        self.genders = self.genders[found]
+        self.polygons = self.polygons[found]
+        self.region_rows = self.region_rows[found]
+
+    def __getitem__(self, idx):
+        """Getter.
+
+        Args:
+            idx (int): index of image list.
+
+        Return:
+            sample (dict): {str: array} formatted data for training.
+        """
+        # a read-only view into the memory-mapped array
+        image_arr = self.images[self.rows[idx]]
+        if self.source_resolution != self.resolution:
+            image_arr = area_downsample(image_arr, self.resolution)
+
+        sample = self.metadata(idx)
+        sample['image'] = image_arr
+        if self.transform is not None:
+            sample = self.transform(sample)
+        return sample
+
+
+class StreamingVGGFace2Dataset(VGGFace2MetadataMixin, IterableDataset):
+    """VGGFace2 Dataset streamed from packed shards.
+
+    Images are read shard by shard from the shards listed in
+    <data_dir>/packed/<resolution>.shards.json, which are built by
+    util/shard_packer.py --shard_size. The shard order is shuffled
+    per epoch and samples are shuffled in a bounded buffer. Shards are split
+    deterministically across distributed ranks and then DataLoader workers,
+    so give it at least (# of ranks) x (# of workers) shards. Every rank
+    streams as many samples as the rank with the fewest, so ranks run the
+    same number of steps.
+    """
+
+    def __init__(self, data_dir, resolution, landmark_info_path,
+                 identity_info_path, filtered_list, use_low_res=False,
+                 transform=None, source_resolution=None,
+                 region_cache=False, decode_threads=0,
+                 shuffle_buffer=1024, seed=0):
+        """Constructor.
+
+        Args:
+            data_dir (str): Directory path containing dataset.
+            resolution (int): Specific resolution value to load.
+            landmark_info (str): Path of the file having landmark information.
+            identity_info (str): Path of the file having identity information.
+            filtered_list (str): Path of the file having filtered list
+                                 information.
+            use_low_res (bool): Use low resolution images or not.
+            transform: Augmentation options, Default is None.
+            source_resolution (int): Resolution of the shards to read,
+                                     which are downsampled to resolution.
+                                     Default is None (resolution).
+            region_cache (bool): Add face regions rasterized once in the
+                                 manifest to samples, Default is False.
+            decode_threads (int): Unused, shards hold decoded images.
+            shuffle_buffer (int): The number of samples in the shuffle
+                                  buffer, Default is 1024.
+            seed (int): Seed of the shard and sample orders.
+        """
+        # only compact per-file arrays are kept, no file list
+        manifest = DatasetManifest(data_dir, landmark_info_path,
+                                   identity_info_path, filtered_list)
+        self.resolution = resolution
+        self.source_resolution = source_resolution or resolution
+        assert self.source_resolution >= resolution
+        indices = manifest.select(self.source_resolution, use_low_res)
+
+        self.keys = np.asarray(manifest.keys[indices])
+        self.landmarks = np.ascontiguousarray(manifest.landmarks[indices])
+        self.genders = np.ascontiguousarray(manifest.genders[indices])
+        self.polygons = np.ascontiguousarray(manifest.polygons[indices])
+        self.regions = None
+        self.region_rows = indices
+        if region_cache:
+            self.regions = manifest.regions(resolution)
+
+        self.pack_dir = os.path.join(data_dir, PACK_DIR_NAME)
+        self.shards = shard_names(self.pack_dir, self.source_resolution)
+        if not self.shards:
+            raise ValueError(f'no shards of {self.source_resolution} in '
+                             f'{self.pack_dir}, see shard_packer.py')
+        # the number of samples of each shard, filtered ones are skipped
+        self.shard_sizes = {}
+        for name in self.shards:
+            _, keys = load_packed(self.pack_dir, name)
+            self.shard_sizes[name] = len(self.shard_rows(keys)[0])
+        self.transform = transform
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        """Set the epoch deciding the shard and sample orders.
+
+        Persistent workers keep their own copy of the dataset and count
+        epochs by themselves.
+
+        Args:
+            epoch (int): epoch
+        """
+        self.epoch = epoch
+
+    def split_shards(self, epoch):
+        """Get shards of the current rank and worker in an epoch.
+
+        Samples of a rank beyond those of the rank with the fewest are
+        skipped, which are at the end of its last shards in the epoch.
+
+        Args:
+            epoch (int): epoch
+
+        Return: tuple, ([(shard name, the number of samples to read)],
+                        (rank, worker id))
+        """
+        rank, world_size = 0, 1
+        if dist.is_available() and dist.is_initialized():
+            rank, world_size = dist.get_rank(), dist.get_world_size()
+        worker_id, num_workers = 0, 1
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+
+        # every rank and worker draws the same order and takes its part
+        order = np.random.RandomState(self.seed + epoch)\
+                         .permutation(len(self.shards))
+        shards = [self.shards[i] for i in order]
+        rank_shards = [shards[r::world_size] for r in range(world_size)]
+        num_samples = min(sum(self.shard_sizes[name] for name in names)
+                          for names in rank_shards)
+
+        counts = []
+        for name in rank_shards[rank]:
+            counts.append(min(self.shard_sizes[name], num_samples))
+            num_samples -= counts[-1]
+        shards = list(zip(rank_shards[rank], counts))[worker_id::num_workers]
+        return shards, (rank, worker_id)
+
+    def read_shard(self, name, num_samples=None):
+        """Yield samples of a shard in the order of the shard.
+
+        Args:
+            name (str): name of a shard
+            num_samples (int): the number of samples to read, Default is
+                               None (all).
+
+        Return: generator of samples
+        """
+        images, keys = load_packed(self.pack_dir, name)
+        rows, idxs = self.shard_rows(keys)
+        for row, idx in zip(rows[:num_samples], idxs[:num_samples]):
+            image_arr = images[row]
+            if self.source_resolution != self.resolution:
+                image_arr = area_downsample(image_arr, self.resolution)
+            sample = self.metadata(idx)
+            sample['image'] = image_arr
+            yield sample
+
+    def shard_rows(self, keys):
+        """Match keys of a shard with the dataset.
+
+        Args:
+            keys (array): keys of a shard.
+
+        Return: tuple, (rows in the shard, indices in the dataset) of
+                shard images in the dataset, filtered ones are skipped.
+        """
+        if len(keys) == 0 or len(self.keys) == 0:
+            return np.zeros(0, np.int64), np.zeros(0, np.int64)
+        idxs = np.searchsorted(self.keys, keys)
+        idxs = np.minimum(idxs, len(self.keys) - 1)
+        rows = np.flatnonzero(self.keys[idxs] == keys)
+        return rows, idxs[rows]
+
+    def __iter__(self):
+        """Iterate over samples of the current rank and worker.
+
+        Return: generator of samples
+        """
+        epoch = self.epoch
+        self.epoch += 1
+        shards, (rank, worker_id) = self.split_shards(epoch)
+        rng = np.random.RandomState([self.seed, epoch, rank, worker_id])
+
+        buffer = []
+        for name, num_samples in shards:
+            for sample in self.read_shard(name, num_samples):
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append(sample)
+                    continue
+                i = rng.randint(len(buffer))
+                buffer[i], sample = sample, buffer[i]
+                yield self.apply_transform(sample)
+
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield self.apply_transform(sample)
+
+    def apply_transform(self, sample):
+        """Apply the transform to a sample."""
+        if self.transform is not None:
+            sample = self.transform(sample)
+        return sample
+
+    def __len__(self):
+        """Get the number of samples of the current epoch.
+
+        The samples are those of the current rank, which is the same on
+        every rank, and of the current worker when called in a DataLoader
+        worker.
+        """
+        shards, _ = self.split_shards(self.epoch)
+        return sum(num_samples for _, num_samples in shards)
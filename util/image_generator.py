@@ -13,25 +13,55 @@ Result directory structure:
                 - ...
                 - all_filtered_results.csv
                 - all_loose_landmarks_256.csv
+                - .image_generator
+                    - n000810.json
+                    - ...
+
+Images already resized (recorded in .image_generator/<identity>.json) are
+skipped unless they have changed, so re-runs only process new or changed
+images and an interrupted run resumes. Resized images of raw images which
+were removed are deleted. Only manifests of changed identities are
+written, so a re-run costs in proportion to what has changed.
 
 python image_generator.py
 """
 
 import os
 import argparse
+from multiprocessing import Pool
 
 import glob
 import cv2
 
+try:
+    from util.content_manifest import ContentManifest, file_signature
+except ImportError:  # run as a script in util/
+    from content_manifest import ContentManifest, file_signature
+
+MANIFEST_DIR_NAME = '.image_generator'
+PRINT_FREQ = 100  # identities
+
 
 class ResizedImageSaver(object):
-    """Resized image saver."""
+    """Resized image saver.
+
+    Each raw image is decoded once and resized to every resolution by
+    chained area downsampling (e.g. 256 -> 128 -> ... -> 4). Identities are
+    spread across a process pool and images are written as they are
+    resized, so only one image per process is held in memory.
+
+    Every raw image is recorded in the manifest of its identity with its
+    signature and the paths of its resized images, so an image edited in
+    place is resized again and the resized images of a removed image are
+    deleted.
+    """
 
     def __init__(self,
                  data_dir,
                  save_dir,
                  resolutions_to=(16, 32),
-                 img_format='png'):
+                 img_format='png',
+                 num_workers=None):
         """constructor.
 
         Args:
@@ -39,40 +69,188 @@ class ResizedImageSaver(object):
             save_dir (str): Directory path saving resized datasets.
             resolutions_to (list): Output image resolutions list.
             img_format (str): 'jpg' or 'png'
-            person_name (str): Specific name want to use for filename,
-                               Default is None.
+            num_workers (int): The number of processes, Default is None
+                               (the number of cpus), 0 resizes on the
+                               current process.
+        """
+        self.save_dir = save_dir
+        self.resolutions_to = sorted(resolutions_to, reverse=True)
+        self.img_format = img_format
+
+        # manifests are kept out of self, which is sent to every task
+        self.manifest_dir = os.path.join(save_dir, MANIFEST_DIR_NAME)
+        os.makedirs(self.manifest_dir, exist_ok=True)
+        params = {'resolutions_to': self.resolutions_to,
+                  'img_format': img_format}
+
+        # an identity whose raw directory was removed keeps no images
+        dir_list = sorted(glob.glob(data_dir + '/n[0-9]*'))
+        cls_ids = [os.path.basename(d) for d in dir_list]
+        recorded = {f[:-len('.json')] for f in os.listdir(self.manifest_dir)
+                    if f.endswith('.json')}
+        num_removed = 0
+        for cls_id in sorted(recorded - set(cls_ids)):
+            num_removed += self.update_manifest(self.manifest(cls_id, params),
+                                                {})
+            os.remove(self.manifest_path(cls_id))
+
+        # only manifests of identities with new or changed images are kept
+        manifests = {}
+        tasks = []
+        num_images = num_todo = 0
+        for d, cls_id in zip(dir_list, cls_ids):
+            signatures = {os.path.basename(f): file_signature(f)
+                          for f in glob.glob(d + f'/*.{img_format}')}
+            manifest = self.manifest(cls_id, params)
+            num_removed += self.update_manifest(manifest, signatures)
+            todo = sorted(file_name
+                          for file_name, signature in signatures.items()
+                          if not manifest.is_done(file_name, signature))
+            num_images += len(signatures)
+            if todo:
+                manifests[cls_id] = (manifest, signatures)
+                tasks.append((d, todo))
+                num_todo += len(todo)
+        print('%d / %d images of %d identities to resize, %d removed'
+              % (num_todo, num_images, len(tasks), num_removed))
+
+        if num_workers == 0:
+            done = map(self.save_identity, tasks)
+            self.record(manifests, done)
+        else:
+            with Pool(num_workers) as pool:
+                done = pool.imap_unordered(self.save_identity, tasks)
+                self.record(manifests, done)
+
+    def manifest_path(self, cls_id):
+        """Get the manifest path of an identity."""
+        return os.path.join(self.manifest_dir, f'{cls_id}.json')
+
+    def manifest(self, cls_id, params):
+        """Load the manifest of the resized images of an identity."""
+        return ContentManifest(self.manifest_path(cls_id), params=params)
+
+    def update_manifest(self, manifest, signatures):
+        """Drop raw images which were removed from a manifest.
+
+        Their resized images are deleted, and the manifest is saved if it
+        has changed.
+
+        Args:
+            manifest (ContentManifest): manifest of an identity.
+            signatures (dict): {file name: signature} of its raw images.
+
+        Return: the number of removed raw images.
         """
-        for res in resolutions_to:
-            dir_list = glob.glob(data_dir + '/n[0-9]*')
-            for d in dir_list:
-                file_list = glob.glob(d + f'/*.{img_format}')
-                imgs = [cv2.imread(i) for i in file_list]
-                imgs_resized = self.resize_image(imgs, res)
-                cls_id = os.path.basename(d)
-                save_cls_dir = os.path.join(save_dir, str(res), cls_id)
+        removed = manifest.prune(signatures)
+        for paths in removed.values():
+            self.remove_outputs(paths)
+        if removed:
+            manifest.save()
+        return len(removed)
 
-                if not os.path.exists(save_cls_dir):
-                    os.makedirs(save_cls_dir)
+    def record(self, manifests, done):
+        """Record resized images in manifests as identities finish.
 
-                self.save_images(file_list, save_cls_dir, imgs_resized)
+        The manifest of an identity is saved once it is resized, so a run
+        writes only manifests of identities it resizes and an interrupted
+        run resumes from the last finished identity.
 
-    def resize_image(self, imgs, res_to):
-        """Image resize to target resolution.
+        Args:
+            manifests (dict): {cls_id: (manifest, signatures of images
+                              before resizing)} of identities to resize.
+            done (iterable): (cls_id, [(file name, output paths)]) of
+                             resized identities.
+        """
+        for i, (cls_id, outputs) in enumerate(done):
+            manifest, signatures = manifests.pop(cls_id)
+            for file_name, paths in outputs:
+                # e.g. an image which can no longer be read
+                stale = set(manifest.outputs.get(file_name, [])) - set(paths)
+                self.remove_outputs(stale)
+                manifest.mark_done(file_name, signatures[file_name], paths)
+            manifest.save()
+            if (i + 1) % PRINT_FREQ == 0:
+                print('%d identities' % (i + 1))
+
+    def save_identity(self, task):
+        """Resize and save images of an identity.
 
         Args:
-            resolutions_to (int): target resolutions.
+            task (tuple): (directory path containing images of an identity,
+                          file names of the images to resize).
 
-        Return: resized images of target resolution.
+        Return: tuple, (cls_id, [(file name, output paths relative to
+                save_dir)] of the images).
         """
-        return [cv2.resize(i, dsize=(res_to, res_to))
-                for i in imgs]
-
-    def save_images(self, file_list, save_dir, imgs_resized):
-        """Save images."""
-        for f, img in zip(file_list, imgs_resized):
-            file_name = os.path.basename(f)
-            save_path = os.path.join(save_dir, file_name)
+        d, file_names = task
+        cls_id = os.path.basename(d)
+        save_cls_dirs = {}
+        for res in self.resolutions_to:
+            save_cls_dirs[res] = os.path.join(self.save_dir, str(res), cls_id)
+            os.makedirs(save_cls_dirs[res], exist_ok=True)
+
+        outputs = []
+        for file_name in file_names:
+            f = os.path.join(d, file_name)
+            img = cv2.imread(f)
+            if img is None:
+                print('Cannot read %s' % f)
+                paths = []
+            else:
+                imgs_resized = self.resize_image(img, self.resolutions_to)
+                paths = self.save_images(f, save_cls_dirs, imgs_resized)
+            outputs.append((file_name, paths))
+        return cls_id, outputs
+
+    def resize_image(self, img, resolutions_to):
+        """Image resize to target resolutions.
+
+        Args:
+            img (array): decoded image.
+            resolutions_to (list): target resolutions in descending order.
+
+        Return: {resolution: resized image} dict.
+        """
+        imgs_resized = {}
+        for res_to in resolutions_to:
+            # every resolution is downsampled from the previous one
+            if img.shape[0] >= res_to and img.shape[1] >= res_to:
+                interpolation = cv2.INTER_AREA
+            else:
+                interpolation = cv2.INTER_LINEAR
+            img = cv2.resize(img, dsize=(res_to, res_to),
+                             interpolation=interpolation)
+            imgs_resized[res_to] = img
+        return imgs_resized
+
+    def save_images(self, file_path, save_dirs, imgs_resized):
+        """Save resized images of a file.
+
+        Return: paths of the saved images relative to save_dir.
+        """
+        file_name = os.path.basename(file_path)
+        paths = []
+        for res, img in imgs_resized.items():
+            save_path = os.path.join(save_dirs[res], file_name)
             cv2.imwrite(save_path, img)
+            paths.append(os.path.relpath(save_path, self.save_dir))
+        return paths
+
+    def remove_outputs(self, paths):
+        """Delete resized images, and their directories left empty.
+
+        Args:
+            paths (iterable): paths of resized images relative to save_dir.
+        """
+        for path in paths:
+            path = os.path.join(self.save_dir, path)
+            if os.path.exists(path):
+                os.remove(path)
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:  # not empty
+                pass
 
 
 if __name__ == "__main__":
@@ -86,9 +264,15 @@ if __name__ == "__main__":
                         help="Directory saving resized images", type=str)
     parser.add_argument("--resolutions_to",
                         default=[4, 8, 16, 32, 64, 128, 256],
-                        help="resolutions want to resize", type=list)
+                        help="resolutions want to resize", type=int,
+                        nargs='+')
+    parser.add_argument("--num_workers",
+                        default=None,
+                        help="The number of processes, Default is # of cpus",
+                        type=int)
     args = parser.parse_args()
 
     ResizedImageSaver(data_dir=args.data_dir,
                       save_dir=args.save_dir,
-                      resolutions_to=args.resolutions_to)
+                      resolutions_to=args.resolutions_to,
+                      num_workers=args.num_workers)
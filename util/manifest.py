@@ -0,0 +1,340 @@
+"""manifest.py.
+
+This module includes the DatasetManifest class
+which caches the file list and per-file metadata of a dataset directory,
+and the PathList class which stores file paths in flat arrays.
+
+Manifest directory structure:
+    ./datasets
+        - VGGFACE2
+            - train
+                - .manifest
+                    - meta.json
+                    - keys.npy
+                    - landmarks.npy
+                    - genders.npy
+                    - categories.npy
+                    - available.npy
+                    - polygons.npy
+                    - regions_4.npy (optional)
+                    - ...
+"""
+
+import os
+import json
+import glob
+import shutil
+
+import cv2
+import numpy as np
+import pandas as pd
+
+from util.content_manifest import file_signature
+from util.csv_merger import read_table
+from util.custom_transforms import face_polygons
+
+MANIFEST_VERSION = 3
+MANIFEST_DIR_NAME = '.manifest'
+IMAGE_EXTENSIONS = ('gif', 'png', 'jpg')
+MANIFEST_ARRAYS = ('keys', 'landmarks', 'genders', 'categories',
+                   'available', 'polygons')
+# resolution of images the landmarks (all_loose_landmarks_256.csv) are on
+LANDMARK_RESOLUTION = 256
+
+# filtering categories
+CATEGORY_GOOD = 0
+CATEGORY_LOW_RES = 1
+CATEGORY_REMOVED = 2
+
+
+class PathList(object):
+    """List of paths stored in one byte buffer and an offsets array.
+
+    Unlike a list of str, indexing it touches no per-path Python objects,
+    so forked DataLoader workers keep sharing its pages with the parent
+    instead of copying them on write.
+    """
+
+    def __init__(self, paths=()):
+        """constructor.
+
+        Args:
+            paths (iterable): str paths.
+        """
+        encoded = [os.fsencode(p) for p in paths]
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(p) for p in encoded], out=self.offsets[1:])
+        self.buffer = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+    def __getitem__(self, idx):
+        """Getter.
+
+        Args:
+            idx (int): index of a path.
+
+        Return: str path.
+        """
+        if idx < 0:
+            idx += len(self)
+        begin, end = self.offsets[idx], self.offsets[idx + 1]
+        return os.fsdecode(self.buffer[begin:end].tobytes())
+
+    def __len__(self):  # noqa: D105
+        return len(self.offsets) - 1
+
+    def take(self, indices):
+        """Get a PathList of the paths at indices.
+
+        Args:
+            indices (array): indices of paths.
+
+        Return: PathList
+        """
+        return PathList(self[i] for i in indices)
+
+
+class DatasetManifest(object):
+    """DatasetManifest classes.
+
+    A manifest is built once per data_dir and shared by every resolution.
+    It is rebuilt only when one of its sources (csv files, resolution
+    directories or identity directories) has changed.
+
+    Attributes:
+        data_dir : dataset directory
+        manifest_dir : directory saving the manifest arrays
+        resolutions : resolutions found in data_dir
+        keys : [N] 'identity/filename' keys in sorted order
+        landmarks : [N, 10] landmarks
+        genders : [N] genders {1: male, 2: female}
+        categories : [N] filtering categories
+        available : [N, # of resolutions] flags for existing images
+        polygons : [N, 6, 2] face-region polygons on images of
+                   polygon_resolution
+        polygon_resolution : resolution of images the landmarks are on
+
+    """
+
+    def __init__(self, data_dir, landmark_info_path,
+                 identity_info_path, filtered_list,
+                 landmark_resolution=LANDMARK_RESOLUTION):
+        """Load the manifest of data_dir, building it if it is stale.
+
+        Args:
+            data_dir (str): Directory path containing dataset.
+            landmark_info_path (str): Path of the file having landmark
+                                      information.
+            identity_info_path (str): Path of the file having identity
+                                      information.
+            filtered_list (str): Path of the file having filtered list
+                                 information.
+            landmark_resolution (int): resolution of images the landmarks
+                                       are on, Default is 256.
+        """
+        self.data_dir = data_dir
+        self.polygon_resolution = landmark_resolution
+        self.manifest_dir = os.path.join(data_dir, MANIFEST_DIR_NAME)
+        self.landmark_info_path = landmark_info_path
+        self.identity_info_path = identity_info_path
+        self.filtered_list = filtered_list
+
+        self.resolutions = sorted(int(d) for d in os.listdir(data_dir)
+                                  if d.isdigit())
+        sources = self.source_signatures()
+
+        if not self.load(sources):
+            self.build()
+            self.save(sources)
+
+    def source_signatures(self):
+        """Get signatures of all sources the manifest depends on."""
+        sources = {}
+        for path in (self.landmark_info_path,
+                     self.identity_info_path,
+                     self.filtered_list):
+            sources[os.path.abspath(path)] = file_signature(path)
+
+        for res in self.resolutions:
+            res_dir = os.path.join(self.data_dir, str(res))
+            sources[str(res)] = file_signature(res_dir)
+            for entry in os.scandir(res_dir):
+                if entry.is_dir():
+                    st = entry.stat()
+                    sources[f'{res}/{entry.name}'] = [st.st_size,
+                                                      st.st_mtime_ns]
+        return sources
+
+    def load(self, sources):
+        """Memory-map the saved manifest if it is up to date.
+
+        Args:
+            sources (dict): current signatures of sources
+
+        Return: True if loaded, False otherwise.
+        """
+        meta_path = os.path.join(self.manifest_dir, 'meta.json')
+        if not os.path.exists(meta_path):
+            return False
+
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get('version') != MANIFEST_VERSION \
+           or meta.get('sources') != sources \
+           or meta.get('polygon_resolution') != self.polygon_resolution:
+            return False
+
+        for name in MANIFEST_ARRAYS:
+            path = os.path.join(self.manifest_dir, name + '.npy')
+            setattr(self, name, np.load(path, mmap_mode='r'))
+        return True
+
+    def save(self, sources):
+        """Save the manifest next to the dataset.
+
+        The arrays are written to a temporary directory first, so an
+        interrupted build never leaves a half-written manifest behind.
+
+        Args:
+            sources (dict): signatures of sources used to build
+        """
+        tmp_dir = self.manifest_dir + f'.tmp-{os.getpid()}'
+        try:
+            os.makedirs(tmp_dir, exist_ok=True)
+            for name in MANIFEST_ARRAYS:
+                np.save(os.path.join(tmp_dir, name + '.npy'),
+                        getattr(self, name))
+
+            meta = {'version': MANIFEST_VERSION,
+                    'resolutions': self.resolutions,
+                    'polygon_resolution': self.polygon_resolution,
+                    'sources': sources}
+            with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+
+            if os.path.exists(self.manifest_dir):
+                shutil.rmtree(self.manifest_dir)
+            os.replace(tmp_dir, self.manifest_dir)
+        except OSError as e:
+            # read-only dataset: keep the manifest in memory only
+            print('Manifest is not saved: %s' % e)
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def build(self):
+        """Build the manifest from the dataset directory and csv files."""
+        # file keys of each resolution
+        res_keys = []
+        for res in self.resolutions:
+            res_dir = os.path.join(self.data_dir, str(res))
+            keys = set()
+            for ext in IMAGE_EXTENSIONS:
+                for path in glob.glob(os.path.join(res_dir, '*', '*.' + ext)):
+                    keys.add(os.path.relpath(path, res_dir)
+                             .replace(os.sep, '/'))
+            res_keys.append(keys)
+        keys = pd.Index(sorted(set().union(*res_keys)), dtype=object)
+
+        # filtering categories (files not in the filtered list are skipped)
+        filtered_list = read_table(self.filtered_list)
+        filtered_list = filtered_list.drop_duplicates('filename')
+        categories = filtered_list.set_index('filename')['category']\
+                                  .reindex(keys)
+        codes = np.full(len(keys), CATEGORY_LOW_RES, dtype=np.uint8)
+        codes[(categories == 'Good').values] = CATEGORY_GOOD
+        codes[(categories == 'Removed').values] = CATEGORY_REMOVED
+
+        # landmarks
+        landmark_info = read_table(self.landmark_info_path)
+        landmark_info = landmark_info.drop_duplicates('NAME_ID')
+        name_ids = keys.str.rsplit('.', n=1).str[0]
+        rows = pd.Index(landmark_info['NAME_ID']).get_indexer(name_ids)
+
+        # genders
+        identity_info = pd.read_csv(self.identity_info_path)
+        identity_info = identity_info.drop_duplicates('Class_ID')
+        cls_to_gender = identity_info.set_index('Class_ID')[' Gender']\
+                                     .apply(lambda x: 2 if x == ' f' else 1)
+        genders = keys.str.split('/').str[0].map(cls_to_gender)
+
+        # files without landmarks or identity cannot be used for training
+        keep = categories.notna().values & (rows >= 0) & genders.notna()
+
+        self.keys = np.array(keys[keep], dtype=bytes)
+        self.landmarks = np.ascontiguousarray(
+            landmark_info.iloc[:, 2:].values[rows[keep]], dtype=np.float32)
+        self.genders = np.asarray(genders[keep], dtype=np.uint8)
+        self.categories = codes[keep]
+        self.available = np.zeros((len(self.keys), len(res_keys)),
+                                  dtype=bool)
+        for i, k in enumerate(res_keys):
+            self.available[:, i] = keys[keep].isin(k)
+
+        # landmarks never change, so neither do the mask polygons
+        polygons = face_polygons(self.landmarks.astype(np.int32))
+        self.polygons = polygons.astype(np.int16)
+
+    def select(self, resolution, use_low_res=False):
+        """Select files of a resolution.
+
+        Args:
+            resolution (int): resolution to load
+            use_low_res (bool): use low resolution images or not
+
+        Return: [M] indices of selected files in the manifest
+        """
+        if resolution not in self.resolutions:
+            return np.zeros(0, dtype=np.int64)
+
+        available = self.available[:, self.resolutions.index(resolution)]
+        if use_low_res:
+            usable = self.categories != CATEGORY_REMOVED
+        else:
+            usable = self.categories == CATEGORY_GOOD
+        return np.flatnonzero(available & usable)
+
+    def paths(self, resolution, indices):
+        """Get image paths of a resolution.
+
+        Args:
+            resolution (int): resolution of images
+            indices (array): indices of files in the manifest
+
+        Return: PathList of image paths
+        """
+        res_dir = os.path.join(self.data_dir, str(resolution))
+        return PathList(os.path.join(res_dir, k.decode())
+                        for k in self.keys[indices])
+
+    def regions(self, resolution):
+        """Get face regions of a resolution, rasterizing them once.
+
+        Args:
+            resolution (int): resolution of regions
+
+        Return: [N, ceil(resolution * resolution / 8)] bit-packed regions,
+                np.unpackbits of a row gives a flattened
+                [resolution, resolution] region.
+        """
+        path = os.path.join(self.manifest_dir, f'regions_{resolution}.npy')
+        if os.path.exists(path):
+            return np.load(path, mmap_mode='r')
+
+        # scaled like the per-sample masks, which floor-divide the
+        # polygons by polygon_resolution // resolution
+        polygons = self.polygons.astype(np.int64) * resolution \
+            // self.polygon_resolution
+        polygons = polygons.astype(np.int32)
+        regions = np.empty((len(polygons), (resolution*resolution + 7) // 8),
+                           dtype=np.uint8)
+        region = np.empty((resolution, resolution), dtype=np.uint8)
+        for i, polygon in enumerate(polygons):
+            region.fill(0)
+            cv2.fillPoly(region, polygon[np.newaxis], 1)
+            regions[i] = np.packbits(region)
+
+        tmp_path = path + f'.tmp-{os.getpid()}.npy'
+        try:
+            np.save(tmp_path, regions)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print('Regions are not saved: %s' % e)
+        return regions
@@ -0,0 +1,119 @@
+"""prefetcher.py.
+
+This module includes the DevicePrefetcher class
+which prepares the next batches of a data loader on a background thread.
+"""
+
+import time
+import queue
+import threading
+
+import torch
+
+
+class DevicePrefetcher(object):
+    """Iterate over a data loader with batches prepared ahead of time.
+
+    A background thread fetches batches from the loader and applies
+    prepare (dtype/device conversion, normalization, masks...) to them,
+    keeping up to depth batches ready. With cuda, prepare runs on a side
+    stream so host-to-device copies overlap the training step. Without
+    cuda, decoding on the main process (num_workers=0) and preparing still
+    overlap the training step.
+
+    Attributes:
+        hidden_time : fetching and preparation time of the last batch
+                      which the training step did not wait for (sec)
+
+    """
+
+    def __init__(self, loader, prepare, depth=2, use_cuda=False):
+        """constructor.
+
+        Args:
+            loader: iterable of batches (e.g. DataLoader).
+            prepare: function converting a batch, returning the batch.
+            depth (int): the maximum number of prepared batches.
+            use_cuda (bool): prepare batches on a cuda side stream.
+        """
+        self.loader = loader
+        self.prepare = prepare
+        self.depth = depth
+        self.stream = torch.cuda.Stream() if use_cuda else None
+        self.hidden_time = 0
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def __iter__(self):
+        """Start prefetching and iterate over prepared batches."""
+        self.close()
+        self.stop_event.clear()
+        self.queue = queue.Queue(maxsize=self.depth)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+        try:
+            while True:
+                wait_time = time.perf_counter()
+                item = self.queue.get()
+                wait_time = time.perf_counter() - wait_time
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+
+                batch, event, prepare_time = item
+                if event is not None:
+                    current = torch.cuda.current_stream()
+                    current.wait_event(event)
+                    for value in batch.values():
+                        if torch.is_tensor(value) and value.is_cuda:
+                            value.record_stream(current)
+
+                self.hidden_time = max(prepare_time - wait_time, 0)
+                yield batch
+        finally:
+            # also when the training loop breaks out early
+            self.close()
+
+    def run(self):
+        """Fetch and prepare batches on the background thread."""
+        try:
+            prepare_time = time.perf_counter()
+            for batch in self.loader:
+                event = None
+                if self.stream is not None:
+                    with torch.cuda.stream(self.stream):
+                        batch = self.prepare(batch)
+                        event = torch.cuda.Event()
+                        event.record(self.stream)
+                else:
+                    batch = self.prepare(batch)
+                prepare_time = time.perf_counter() - prepare_time
+                if not self.put((batch, event, prepare_time)):
+                    return
+                prepare_time = time.perf_counter()
+            self.put(None)
+        except Exception as e:  # raised again on the training thread
+            self.put(e)
+
+    def put(self, item):
+        """Put an item into the queue unless the prefetcher is closed.
+
+        Return: True if put, False if closed.
+        """
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def close(self):
+        """Stop the background thread, dropping prepared batches."""
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
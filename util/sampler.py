@@ -0,0 +1,96 @@
+"""sampler.py.
+
+This module includes the InfiniteSampler class
+which yields dataset indices endlessly from a resumable position.
+"""
+
+import numpy as np
+from torch.utils.data import Sampler
+
+
+class InfiniteSampler(Sampler):
+    """Sample indices endlessly, epoch after epoch.
+
+    The order of an epoch is a permutation drawn from (seed, epoch), so
+    the position (epoch, offset) is enough to continue with the exact
+    next sample. The DataLoader draws indices ahead of training, so the
+    trainer calls advance with the number of samples it has consumed and
+    the position saved in checkpoints is that of training.
+
+    Attributes:
+        seed : seed of permutations
+        epoch : epoch of the next sample to train
+        offset : offset in the epoch of the next sample to train
+
+    """
+
+    def __init__(self, data_source, seed=0, shuffle=True):
+        """constructor.
+
+        Args:
+            data_source: dataset to sample from.
+            seed (int): seed of permutations.
+            shuffle (bool): shuffle every epoch or not.
+        """
+        self.num_samples = len(data_source)
+        self.seed = seed
+        self.shuffle = shuffle
+        self.epoch = 0
+        self.offset = 0
+
+    def __iter__(self):
+        """Iterate over indices from the current position."""
+        if self.num_samples == 0:
+            return
+        epoch, offset = self.epoch, self.offset
+        while True:
+            for idx in self.permutation(epoch)[offset:]:
+                yield int(idx)
+            epoch += 1
+            offset = 0
+
+    def __len__(self):
+        """Get the number of samples of an epoch."""
+        return self.num_samples
+
+    def permutation(self, epoch):
+        """Get the order of indices in an epoch.
+
+        Args:
+            epoch (int): epoch
+
+        Return: [N] indices
+        """
+        if not self.shuffle:
+            return np.arange(self.num_samples)
+        rng = np.random.RandomState([self.seed, epoch])
+        return rng.permutation(self.num_samples)
+
+    def advance(self, num_samples):
+        """Move the position by the number of samples consumed in training.
+
+        Args:
+            num_samples (int): the number of consumed samples.
+        """
+        self.offset += num_samples
+        self.epoch += self.offset // self.num_samples
+        self.offset %= self.num_samples
+
+    def state_dict(self):
+        """Get the position to save in a checkpoint."""
+        return {'seed': self.seed,
+                'epoch': self.epoch,
+                'offset': self.offset,
+                'num_samples': self.num_samples}
+
+    def load_state_dict(self, state_dict):
+        """Restore the position saved in a checkpoint.
+
+        Args:
+            state_dict (dict): position returned by state_dict.
+        """
+        assert state_dict['num_samples'] == self.num_samples, \
+            'the dataset has changed since the checkpoint'
+        self.seed = state_dict['seed']
+        self.epoch = state_dict['epoch']
+        self.offset = state_dict['offset']
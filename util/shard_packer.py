@@ -0,0 +1,245 @@
+"""Pack resized images into memory-mapped arrays.
+
+Result directory structure:
+    ./datasets
+        - VGGFACE2
+            - train
+                - 4
+                - 8
+                - ...
+                - packed
+                    - 4.npy
+                    - 4.keys.npy
+                    - 8.npy
+                    - 8.keys.npy
+                    - ...
+                    - 256.shards.json (with --shard_size)
+                    - 256-00000.npy
+                    - 256-00000.keys.npy
+                    - ...
+
+Each <resolution>.npy is a uint8 [N, resolution, resolution, channels]
+array and <resolution>.keys.npy holds the sorted 'identity/filename'
+keys of its rows (packs of tfrecord_extractor.py keep record order).
+
+With --shard_size, each resolution is split into shards of at most
+shard_size images, <resolution>-00000.npy, <resolution>-00001.npy, ...,
+for streaming datasets. Keys are shuffled with --seed before they are
+split, so every shard holds images of many identities in a random order,
+and <resolution>.shards.json lists the shards. The list is written after
+the shards, and shards of an earlier pack are deleted first, so an
+interrupted pack leaves no shards to stream.
+
+python shard_packer.py
+"""
+
+import os
+import glob
+import json
+import argparse
+
+import numpy as np
+from PIL import Image
+
+PACK_DIR_NAME = 'packed'
+IMAGE_EXTENSIONS = ('gif', 'png', 'jpg')
+
+
+def packed_paths(pack_dir, name):
+    """Get paths of a packed image array and its key index.
+
+    Args:
+        pack_dir (str): Directory path containing packed arrays.
+        name: Name of the packed array (e.g. resolution).
+
+    Return: tuple, (image array path, key index path)
+    """
+    return (os.path.join(pack_dir, f'{name}.npy'),
+            os.path.join(pack_dir, f'{name}.keys.npy'))
+
+
+def load_packed(pack_dir, name):
+    """Memory-map a packed image array and load its key index.
+
+    Args:
+        pack_dir (str): Directory path containing packed arrays.
+        name: Name of the packed array (e.g. resolution).
+
+    Return: tuple, (images, keys)
+    """
+    images_path, keys_path = packed_paths(pack_dir, name)
+    images = np.load(images_path, mmap_mode='r')
+    keys = np.load(keys_path)
+    if len(keys) != len(images):
+        raise ValueError(f'{keys_path} has {len(keys)} keys for '
+                         f'{len(images)} images, pack {name} again')
+    return images, keys
+
+
+def shard_list_path(pack_dir, resolution):
+    """Get the path of the shard list of a resolution."""
+    return os.path.join(pack_dir, f'{resolution}.shards.json')
+
+
+def shard_names(pack_dir, resolution):
+    """Get names of the shards of a resolution.
+
+    Args:
+        pack_dir (str): Directory path containing packed arrays.
+        resolution (int): resolution of shards.
+
+    Return: list of shard names, empty if the resolution is not packed
+            into shards.
+    """
+    path = shard_list_path(pack_dir, resolution)
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_packed(pack_dir, name, keys, images_iter, shape, num_images=None):
+    """Write images into a packed array.
+
+    The array and its keys are written under temporary names and renamed
+    at the end, the array last, so readers never see a partially packed
+    array and load_packed detects keys left by an interrupted run.
+
+    Args:
+        pack_dir (str): Directory path saving packed arrays.
+        name: Name of the packed array (e.g. resolution).
+        keys (list): keys of images in the order of images_iter, which may
+                     be filled while images_iter is consumed if num_images
+                     is given.
+        images_iter: iterable of uint8 [H, W, C] images.
+        shape (tuple): [H, W, C] shape of each image.
+        num_images (int): The number of images, Default is len(keys).
+    """
+    os.makedirs(pack_dir, exist_ok=True)
+    images_path, keys_path = packed_paths(pack_dir, name)
+    tmp_path = images_path + '.tmp.npy'
+
+    if num_images is None:
+        num_images = len(keys)
+    images = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                       shape=(num_images,) + tuple(shape))
+    for i, img in enumerate(images_iter):
+        images[i] = img
+    images.flush()
+    del images
+
+    tmp_keys_path = keys_path + '.tmp.npy'
+    np.save(tmp_keys_path, np.array(keys, dtype=bytes))
+    os.replace(tmp_keys_path, keys_path)
+    os.replace(tmp_path, images_path)
+
+
+class ShardPacker(object):
+    """Pack per-resolution image directories into uint8 arrays."""
+
+    def __init__(self, data_dir, pack_dir=None, num_channels=3):
+        """constructor.
+
+        Args:
+            data_dir (str): Directory path containing resized datasets.
+            pack_dir (str): Directory path saving packed arrays,
+                            Default is <data_dir>/packed.
+            num_channels (int): The number of image channels.
+        """
+        self.data_dir = data_dir
+        self.pack_dir = pack_dir or os.path.join(data_dir, PACK_DIR_NAME)
+        self.num_channels = num_channels
+
+    def pack(self, resolution, shard_size=None, seed=0):
+        """Pack images of a resolution.
+
+        Args:
+            resolution (int): resolution to pack.
+            shard_size (int): the maximum number of images of a shard,
+                              Default is None (a single array).
+            seed (int): seed of the order of keys split into shards.
+
+        Return: the number of packed images.
+        """
+        res_dir = os.path.join(self.data_dir, str(resolution))
+        keys = []
+        for ext in IMAGE_EXTENSIONS:
+            for path in glob.glob(os.path.join(res_dir, '*', '*.' + ext)):
+                keys.append(os.path.relpath(path, res_dir)
+                            .replace(os.sep, '/'))
+        keys.sort()
+
+        shape = (resolution, resolution, self.num_channels)
+        if shard_size is None:
+            shards = [(resolution, keys)]
+        else:
+            self.remove_shards(resolution)
+            # a sorted slice would hold a few whole identities
+            order = np.random.RandomState(seed).permutation(len(keys))
+            keys = [keys[i] for i in order]
+            shards = [(f'{resolution}-{i // shard_size:05d}',
+                       keys[i:i + shard_size])
+                      for i in range(0, len(keys), shard_size)]
+
+        for name, shard_keys in shards:
+            images = (self.read_image(os.path.join(res_dir, k), shape)
+                      for k in shard_keys)
+            write_packed(self.pack_dir, name, shard_keys, images, shape)
+
+        if shard_size is not None:
+            path = shard_list_path(self.pack_dir, resolution)
+            with open(path + '.tmp', 'w') as f:
+                json.dump([name for name, _ in shards], f)
+            os.replace(path + '.tmp', path)
+        return len(keys)
+
+    def remove_shards(self, resolution):
+        """Delete the shard list and the shards of a resolution."""
+        path = shard_list_path(self.pack_dir, resolution)
+        if os.path.exists(path):
+            os.remove(path)
+        for ext in ('npy', 'keys.npy'):
+            pattern = os.path.join(self.pack_dir, f'{resolution}-*.{ext}')
+            for shard_path in glob.glob(pattern):
+                os.remove(shard_path)
+
+    def read_image(self, path, shape):
+        """Read an image as a uint8 array of the given shape."""
+        img = Image.open(path)
+        if self.num_channels == 3 and img.mode != 'RGB':
+            img = img.convert('RGB')
+        img_arr = np.asarray(img, dtype=np.uint8)
+        if img_arr.ndim == 2:
+            img_arr = img_arr[:, :, np.newaxis]
+        if img_arr.shape != shape:
+            raise ValueError(f'{path}: expected shape {shape}, '
+                             f'got {img_arr.shape}')
+        return img_arr
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir",
+                        default="../dataset/VGGFACE2/train",
+                        help="Directory containing resized images", type=str)
+    parser.add_argument("--pack_dir",
+                        default=None,
+                        help="Directory saving packed arrays", type=str)
+    parser.add_argument("--resolutions",
+                        default=[4, 8, 16, 32, 64, 128, 256],
+                        help="resolutions want to pack", type=int,
+                        nargs='+')
+    parser.add_argument("--shard_size",
+                        default=None,
+                        help="Images per shard, Default is a single array",
+                        type=int)
+    parser.add_argument("--seed",
+                        default=0,
+                        help="Seed of the order of images in shards",
+                        type=int)
+    args = parser.parse_args()
+
+    packer = ShardPacker(args.data_dir, args.pack_dir)
+    for res in args.resolutions:
+        print('%dx%d: %d images'
+              % (res, res, packer.pack(res, args.shard_size, args.seed)))
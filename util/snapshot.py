@@ -13,6 +13,7 @@ import threading
 
 import util.util as util
 from util.logger import Logger
+from util.spectral_norm import power_iteration_counts
 from util.util import Phase
 
 
@@ -27,6 +28,7 @@ class Snapshot(object):
         _resolution : resolution restored
         _phase : phase restored
         _it : # of iterations restored
+        _sampler_state : position of the sampler restored
         exp_dir : export directory
         time : restored time
         sample_dir : smaple snapshot directory
@@ -35,6 +37,8 @@ class Snapshot(object):
         logger : logger
         g_losses : losses of generator
         d_losses : losses of discriminator
+        loader_stats : statistics of data loading
+        power_iterations : (run, saved) spectral norm power iterations of D
         real : real images
         syn : synthesized images
 
@@ -46,6 +50,7 @@ class Snapshot(object):
         self.use_cuda = use_coda
         self.current_time = time.strftime('%Y-%m-%d %H%M%S')
         self.is_restored = False
+        self._sampler_state = None
 
     def restore_model(self, G, D, optim_G, optim_D):
         """Restore model from checkpoint.
@@ -92,11 +97,14 @@ class Snapshot(object):
         D.load_state_dict(checkpoint["D"])
         optim_G.load_state_dict(checkpoint["optim_G"])
         optim_D.load_state_dict(checkpoint["optim_D"])
+        # checkpoints from before the sampler was saved have no position
+        self._sampler_state = checkpoint.get("sampler")
 
         print('Restored from dir: %s, pattern: %s' %
               (self.exp_dir, which_file))
 
-    def save_model(self, file_name, G, D, optim_G, optim_D):
+    def save_model(self, file_name, G, D, optim_G, optim_D,
+                   sampler_state=None):
         """Save_model.
 
         Args:
@@ -105,6 +113,7 @@ class Snapshot(object):
             D: discriminator
             optim_G: optimizer of generator
             optim_D: optimizer of discriminator
+            sampler_state: position of the sampler, Default is None
 
         """
         checkpoint = {
@@ -113,6 +122,8 @@ class Snapshot(object):
             'optim_G': optim_G.state_dict(),
             'optim_D': optim_D.state_dict()
         }
+        if sampler_state is not None:
+            checkpoint['sampler'] = sampler_state
         torch.save(checkpoint, file_name)
 
     def new_directory(self):
@@ -149,7 +160,9 @@ class Snapshot(object):
                  optim_G,
                  optim_D,
                  g_losses,
-                 d_losses):
+                 d_losses,
+                 loader_stats=None,
+                 sampler=None):
         """Snapshot.
 
         Args:
@@ -168,10 +181,14 @@ class Snapshot(object):
             optim_D: optimizer of discriminator
             g_losses : losses of generator
             d_losses : losses of discriminator
+            loader_stats : statistics of data loading
+            sampler : sampler of the training set
 
         """
         self.g_losses = g_losses
         self.d_losses = d_losses
+        self.loader_stats = loader_stats
+        self.power_iterations = power_iteration_counts(D)
         self.real = real
         self.syn = syn
 
@@ -179,8 +196,10 @@ class Snapshot(object):
         self.line_summary(global_it, it, total_it, phase, cur_resol, cur_level)
         self.log_loss_to_tensorboard(global_it)
 
+        # the position is taken now, the snapshot may run on a thread
+        sampler_state = sampler.state_dict() if sampler is not None else None
         args = (global_it, it, total_it, phase, cur_resol, cur_level,
-                minibatch_size, G, D, optim_G, optim_D)
+                minibatch_size, G, D, optim_G, optim_D, sampler_state)
 
         if self.config.snapshot.enable_threading:
             t = threading.Thread(target=self.periodic_snapshot, args=args)
@@ -199,7 +218,8 @@ class Snapshot(object):
                           G,
                           D,
                           optim_G,
-                          optim_D):
+                          optim_D,
+                          sampler_state=None):
         """Snapshot.
 
         Args:
@@ -214,6 +234,7 @@ class Snapshot(object):
             D: discriminator
             optim_G: optimizer of generator
             optim_D: optimizer of discriminator
+            sampler_state: position of the sampler
 
         """
         sample_freq_dict = self.config.snapshot.sample_freq_dict
@@ -245,7 +266,7 @@ class Snapshot(object):
                                                phase,
                                                str(it).zfill(6))
             self.save_model(os.path.join(self.ckpt_dir, filename),
-                            G, D, optim_G, optim_D)
+                            G, D, optim_G, optim_D, sampler_state)
 
     def line_summary(self,
                      global_it,
@@ -292,6 +313,14 @@ class Snapshot(object):
                   self.d_losses.pixel_loss_real,
                   self.d_losses.pixel_loss_syn)
 
+        if self.loader_stats is not None:
+            formation += '| Data:%.3fs Hidden:%.3fs'
+            values += (self.loader_stats.data_time,
+                       self.loader_stats.hidden_time)
+        if sum(self.power_iterations) > 0:
+            formation += '| SN iters:%d saved:%d'
+            values += self.power_iterations
+
         print(formation % values)
 
     def image_sampling(self, minibatch_size):
@@ -373,6 +402,15 @@ class Snapshot(object):
                 'Discriminator/Pixelwise Classfication Loss (S)':
                 self.d_losses.pixel_loss_syn}
 
+        if self.loader_stats is not None:
+            info['Loader/Data Wait Time'] = self.loader_stats.data_time
+            info['Loader/Prefetch Hidden Time'] = \
+                self.loader_stats.hidden_time
+        if sum(self.power_iterations) > 0:
+            info['Discriminator/Power Iterations'] = self.power_iterations[0]
+            info['Discriminator/Saved Power Iterations'] = \
+                self.power_iterations[1]
+
         for tag, value in info.items():
             self.logger.scalar_summary(tag, value, global_it)
 
@@ -2,11 +2,24 @@
 Spectral Normalization.
 
 https://arxiv.org/abs/1802.05957
+
+With the power iteration cache (set_power_iteration_cache), the power
+iteration runs once per update of a weight, not on every forward: the
+singular vectors are kept until the weight changes, which is detected by
+its version counter (bumped by the in-place update of optimizer steps).
+sigma and the normalized weight are still computed on every forward, so
+each forward has its own graph for backward.
 """
 import torch
 from torch.nn.functional import normalize
 
 
+def is_compiling():
+    """Whether torch.compile is tracing or not."""
+    compiler = getattr(torch, 'compiler', None)
+    return hasattr(compiler, 'is_compiling') and compiler.is_compiling()
+
+
 class SpectralNorm(object):
     """SpectralNorm class."""
 
@@ -23,6 +36,13 @@ class SpectralNorm(object):
         self.n_power_iterations = n_power_iterations
         self.eps = eps
 
+        self.cache = False
+        self.cache_key = None
+        self.v = None
+        # the number of power iterations run and skipped by the cache
+        self.iterations = 0
+        self.saved_iterations = 0
+
     def compute_weight(self, module):
         """Compute_weight.
 
@@ -42,17 +62,29 @@ class SpectralNorm(object):
         height = weight_mat.size(0)
         weight_mat = weight_mat.reshape(height, -1)
 
-        with torch.no_grad():
-            for _ in range(self.n_power_iterations):
-                # Spectral norm of weight equals to `u^T W v`, where `u` and
-                # `v`are the first left and right singular vectors.
-                # This power iteration produces approximations of `u` and `v`.
-                v = normalize(torch.matmul(weight_mat.t(), u),
-                              dim=0,
-                              eps=self.eps)
-                u = normalize(torch.matmul(weight_mat, v),
-                              dim=0,
-                              eps=self.eps)
+        # the version changes with in-place updates, the pointer with moves
+        # (neither can be traced by torch.compile, which runs without cache)
+        cache = self.cache and not is_compiling()
+        key = (weight.data_ptr(), weight._version) if cache else None
+        if cache and self.cache_key == key:
+            v = self.v
+            self.saved_iterations += self.n_power_iterations
+        else:
+            with torch.no_grad():
+                for _ in range(self.n_power_iterations):
+                    # Spectral norm of weight equals to `u^T W v`, where `u`
+                    # and `v`are the first left and right singular vectors.
+                    # This power iteration produces approximations of `u` and
+                    # `v`.
+                    v = normalize(torch.matmul(weight_mat.t(), u),
+                                  dim=0,
+                                  eps=self.eps)
+                    u = normalize(torch.matmul(weight_mat, v),
+                                  dim=0,
+                                  eps=self.eps)
+            self.iterations += self.n_power_iterations
+            if cache:
+                self.cache_key, self.v = key, v
 
         sigma = torch.dot(u, torch.matmul(weight_mat, v))
         weight = weight / sigma
@@ -68,7 +100,8 @@ class SpectralNorm(object):
         delattr(module, self.name)
         delattr(module, self.name + '_u')
         delattr(module, self.name + '_orig')
-        module.register_parameter(self.name, torch.nn.Parameter(weight))
+        module.register_parameter(self.name,
+                                  torch.nn.Parameter(weight.detach()))
 
     def __call__(self, module, inputs):
         """__call__.
@@ -170,6 +203,48 @@ def spectral_norm(module,
     return module
 
 
+def spectral_norms(module):
+    """Iterate over spectral normalizations of a module and its children.
+
+    Args:
+        module (nn.Module): containing module
+
+    Return: generator of SpectralNorm
+    """
+    for m in module.modules():
+        for hook in m._forward_pre_hooks.values():
+            if isinstance(hook, SpectralNorm):
+                yield hook
+
+
+def set_power_iteration_cache(module, enabled=True):
+    """Run power iterations once per weight update in a module.
+
+    Args:
+        module (nn.Module): containing module
+        enabled (bool): use the cache or not, Default is True.
+    """
+    for fn in spectral_norms(module):
+        fn.cache = enabled
+        fn.cache_key = None
+        fn.v = None
+
+
+def power_iteration_counts(module):
+    """Count power iterations of spectral normalizations in a module.
+
+    Args:
+        module (nn.Module): containing module
+
+    Return: tuple, (# of iterations run, # of iterations saved by the cache)
+    """
+    iterations = saved_iterations = 0
+    for fn in spectral_norms(module):
+        iterations += fn.iterations
+        saved_iterations += fn.saved_iterations
+    return iterations, saved_iterations
+
+
 def remove_spectral_norm(module, name='weight'):
     """Remove the spectral normalization reparameterization from a module.
 
@@ -189,3 +264,23 @@ def remove_spectral_norm(module, name='weight'):
 
     raise ValueError("spectral_norm of '{}' not found in {}".format(
         name, module))
+
+
+def fold_spectral_norm(module):
+    """Fold spectral normalizations of a module into plain weights.
+
+    Every normalized weight is replaced by the weight used in eval mode
+    (normalized by the last training forward), so the module runs without
+    forward pre-hooks.
+
+    Args:
+        module (nn.Module): containing module
+
+    Returns:
+        The module without spectral normalizations
+    """
+    for m in module.modules():
+        for fn in [hook for hook in m._forward_pre_hooks.values()
+                   if isinstance(hook, SpectralNorm)]:
+            remove_spectral_norm(m, fn.name)
+    return module
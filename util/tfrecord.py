@@ -0,0 +1,278 @@
+"""tfrecord.py.
+
+This module reads TFRecord files without TensorFlow.
+
+A TFRecord file is a sequence of records framed as
+    uint64 length
+    uint32 masked crc32c of length
+    byte   data[length]
+    uint32 masked crc32c of data
+and the data of each record is a serialized tf.train.Example, which is
+decoded by a minimal protobuf decoder.
+
+crc32c checks of the data use the crc32c module when it is installed,
+and are skipped otherwise unless asked for (the pure-python fallback is
+slow for large images).
+"""
+
+import os
+import struct
+
+import numpy as np
+
+try:
+    from crc32c import crc32c as fast_crc32c
+except ImportError:
+    fast_crc32c = None
+
+HEADER_SIZE = 12  # length and its crc
+FOOTER_SIZE = 4  # crc of data
+CRC_MASK_DELTA = 0xa282ead8
+
+
+def make_crc32c_table():
+    """Make the lookup table of the crc32c (Castagnoli) polynomial."""
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82f63b78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+CRC32C_TABLE = make_crc32c_table()
+
+
+def crc32c(data):
+    """Compute the crc32c of bytes.
+
+    Args:
+        data (bytes): data.
+
+    Return: int crc32c
+    """
+    if fast_crc32c is not None:
+        return fast_crc32c(data)
+    crc = 0xffffffff
+    for b in bytes(data):
+        crc = CRC32C_TABLE[(crc ^ b) & 0xff] ^ (crc >> 8)
+    return crc ^ 0xffffffff
+
+
+def masked_crc32c(data):
+    """Compute the masked crc32c of bytes used by TFRecord."""
+    crc = crc32c(data)
+    return (((crc >> 15) | (crc << 17)) + CRC_MASK_DELTA) & 0xffffffff
+
+
+def read_record(f, offset=None, check_crc=None):
+    """Read a record of a TFRecord file.
+
+    Args:
+        f: binary file object.
+        offset (int): offset of the record, Default is None (current).
+        check_crc (bool): check the crc of the data, Default is None
+                          (only with the crc32c module).
+
+    Return: bytes of the record, None at the end of the file.
+    """
+    if offset is not None:
+        f.seek(offset)
+    header = f.read(HEADER_SIZE)
+    if not header:
+        return None
+    if len(header) != HEADER_SIZE:
+        raise IOError('truncated record header')
+
+    length_bytes = header[:8]
+    length, length_crc = struct.unpack('<QI', header)
+    if masked_crc32c(length_bytes) != length_crc:
+        raise IOError('corrupted record length')
+
+    data = f.read(length)
+    footer = f.read(FOOTER_SIZE)
+    if len(data) != length or len(footer) != FOOTER_SIZE:
+        raise IOError('truncated record')
+
+    if check_crc is None:
+        check_crc = fast_crc32c is not None
+    if check_crc and \
+       masked_crc32c(data) != struct.unpack('<I', footer)[0]:
+        raise IOError('corrupted record data')
+    return data
+
+
+def read_record_at(fd, offset, length, check_crc=None):
+    """Read a record at an offset with a single positional read.
+
+    Positional reads do not move the file offset, so threads can share fd.
+
+    Args:
+        fd (int): file descriptor of a TFRecord file.
+        offset (int): offset of the record.
+        length (int): length of the data of the record.
+        check_crc (bool): check the crc of the data, Default is None
+                          (only with the crc32c module).
+
+    Return: bytes of the record.
+    """
+    buf = os.pread(fd, HEADER_SIZE + length + FOOTER_SIZE, offset)
+    if len(buf) != HEADER_SIZE + length + FOOTER_SIZE:
+        raise IOError('truncated record')
+    if struct.unpack('<Q', buf[:8])[0] != length:
+        raise IOError('record length does not match the index')
+
+    data = buf[HEADER_SIZE:HEADER_SIZE + length]
+    if check_crc is None:
+        check_crc = fast_crc32c is not None
+    if check_crc and \
+       masked_crc32c(data) != struct.unpack('<I', buf[-FOOTER_SIZE:])[0]:
+        raise IOError('corrupted record data')
+    return data
+
+
+def iter_tfrecord(path, check_crc=None):
+    """Iterate over records of a TFRecord file.
+
+    Args:
+        path (str): path of a TFRecord file.
+        check_crc (bool): check the crc of the data, Default is None
+                          (only with the crc32c module).
+
+    Return: generator of bytes of records
+    """
+    with open(path, 'rb') as f:
+        while True:
+            data = read_record(f, check_crc=check_crc)
+            if data is None:
+                return
+            yield data
+
+
+def index_tfrecord(path):
+    """Index records of a TFRecord file, reading only record headers.
+
+    Args:
+        path (str): path of a TFRecord file.
+
+    Return: [N, 2] int64 array of (offset, length) of records
+    """
+    index = []
+    with open(path, 'rb') as f:
+        offset = 0
+        while True:
+            header = f.read(HEADER_SIZE)
+            if not header:
+                break
+            if len(header) != HEADER_SIZE:
+                raise IOError('truncated record header')
+            length, length_crc = struct.unpack('<QI', header)
+            if masked_crc32c(header[:8]) != length_crc:
+                raise IOError('corrupted record length')
+            index.append((offset, length))
+            offset += HEADER_SIZE + length + FOOTER_SIZE
+            f.seek(offset)
+    return np.array(index, dtype=np.int64).reshape(-1, 2)
+
+
+# ----------------------------------------------------------------------------
+# Minimal tf.train.Example decoder
+
+def read_varint(buf, pos):
+    """Read a protobuf varint.
+
+    Return: tuple, (value, next position)
+    """
+    value = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        value |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return value, pos
+        shift += 7
+
+
+def iter_fields(buf):
+    """Iterate over fields of a serialized protobuf message.
+
+    Return: generator of (field number, wire type, value), value is an int
+            for varints and a memoryview for the others.
+    """
+    buf = memoryview(buf)
+    pos = 0
+    while pos < len(buf):
+        tag, pos = read_varint(buf, pos)
+        number, wire_type = tag >> 3, tag & 7
+        if wire_type == 0:
+            value, pos = read_varint(buf, pos)
+        elif wire_type == 1:
+            value, pos = buf[pos:pos + 8], pos + 8
+        elif wire_type == 2:
+            length, pos = read_varint(buf, pos)
+            value, pos = buf[pos:pos + length], pos + length
+        elif wire_type == 5:
+            value, pos = buf[pos:pos + 4], pos + 4
+        else:
+            raise ValueError(f'unsupported wire type {wire_type}')
+        yield number, wire_type, value
+
+
+def parse_feature(buf):
+    """Parse a tf.train.Feature.
+
+    Return: list of bytes, [N] float32 array or [N] int64 array
+    """
+    for number, _, value in iter_fields(buf):
+        if number == 1:  # BytesList
+            return [v.tobytes() for n, _, v in iter_fields(value) if n == 1]
+        if number == 2:  # FloatList
+            floats = []
+            for n, _, v in iter_fields(value):
+                if n == 1:  # packed (2) or not (5)
+                    floats.append(np.frombuffer(v, dtype='<f4'))
+            return np.concatenate(floats) if floats \
+                else np.zeros(0, dtype=np.float32)
+        if number == 3:  # Int64List
+            ints = []
+            for n, wire_type, v in iter_fields(value):
+                if n != 1:
+                    continue
+                if wire_type == 0:
+                    ints.append(v)
+                else:  # packed
+                    pos = 0
+                    while pos < len(v):
+                        i, pos = read_varint(v, pos)
+                        ints.append(i)
+            # varints of negative int64 are 64-bit two's complement
+            return np.array(ints, dtype=np.uint64).view(np.int64)
+    return []
+
+
+def parse_example(buf):
+    """Parse a serialized tf.train.Example.
+
+    Args:
+        buf (bytes): serialized tf.train.Example.
+
+    Return: {str: feature} dict, a feature is a list of bytes,
+            a float32 array or an int64 array.
+    """
+    features = {}
+    for number, _, value in iter_fields(buf):
+        if number != 1:  # Features
+            continue
+        for n, _, entry in iter_fields(value):
+            if n != 1:  # map<string, Feature> entry
+                continue
+            key, feature = None, b''
+            for m, _, v in iter_fields(entry):
+                if m == 1:
+                    key = v.tobytes().decode()
+                elif m == 2:
+                    feature = v
+            features[key] = parse_feature(feature)
+    return features
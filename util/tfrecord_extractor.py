@@ -1,49 +1,119 @@
-"""Extract CelebA-HQ tfrecord format files."""
+"""Extract CelebA-HQ tfrecord format files.
+
+Files are extracted in parallel, one tfrecord file (one resolution) per
+process, into png files or, with --pack_dir, into packed uint8 arrays
+<pack_dir>/<resolution>.npy (see shard_packer.py) whose keys are the png
+file names in record order. Unlike packs of shard_packer.py, the keys are
+not sorted, so the arrays are written in a single pass over the records;
+PackedVGGFace2Dataset sorts the keys of such packs when it loads them.
+"""
 
 import os
 import argparse
+from multiprocessing import Pool
 
 import glob
 import numpy as np
-import tensorflow as tf
-import matplotlib.pyplot as plt
+from PIL import Image
+
+try:
+    from util.shard_packer import write_packed
+    from util.tfrecord import index_tfrecord, iter_tfrecord, parse_example
+except ImportError:  # run as a script in util/
+    from shard_packer import write_packed
+    from tfrecord import index_tfrecord, iter_tfrecord, parse_example
 
 
 def parse_tfrecord_np(tfr_file):
     """Parse numpy array from tfrecord file.
 
     Args:
-        tfr_file: tfrecord file path.
+        tfr_file: serialized record of a tfrecord file.
 
     Return: tuple, (array, array)
     """
-    ex = tf.train.Example()
-    ex.ParseFromString(tfr_file)
-    shape = ex.features.feature['shape'].int64_list.value
-    data = ex.features.feature['data'].bytes_list.value[0]
-    attr = ex.features.feature['attr'].bytes_list.value[0]
-    return np.fromstring(data, np.uint8).reshape(shape), \
-        np.fromstring(attr, np.uint8)
+    ex = parse_example(tfr_file)
+    shape = ex['shape']
+    data = ex['data'][0]
+    attr = ex['attr'][0]
+    return np.frombuffer(data, np.uint8).reshape(shape), \
+        np.frombuffer(attr, np.uint8)
+
+
+def image_file_name(attr, i):
+    """Get the png file name of the i-th image."""
+    return ''.join([str(a) for a in attr]) + f'_{i}.png'
 
 
-def extract_tfrecord_png(tfr_files, save_dir):
-    """Extract png image files from tfrecord.
+def iter_tfrecord_images(tfr_file):
+    """Iterate over images of a tfrecord file.
+
+    Args:
+        tfr_file: tfrecord file path.
+
+    Return: generator of (file name, [H, W, C] image)
+    """
+    for i, record in enumerate(iter_tfrecord(tfr_file)):
+        img, attr = parse_tfrecord_np(record)
+        yield image_file_name(attr, i), img.transpose(1, 2, 0)
+
+
+def extract_tfrecord_file(tfr_file, save_dir, pack_dir=None):
+    """Extract images of a tfrecord file.
 
     Args:
         tfr_file: tfrecord file path.
         save_dir: directory path for saving images.
+        pack_dir: directory path for saving packed arrays instead of png
+                  files, Default is None.
+
+    Return: the number of extracted images.
     """
-    for tfr_file in tfr_files:
-        tfr_opt = tf.python_io.TFRecordOptions(tf.python_io.TFRecordCompressionType.NONE) # noqa E501
-        i = 0
-        for record in tf.python_io.tf_record_iterator(tfr_file, tfr_opt):
-            img, attr = parse_tfrecord_np(record)
-            img = img.transpose(1, 2, 0)
+    if pack_dir is None:
+        count = 0
+        for name, img in iter_tfrecord_images(tfr_file):
             res = str(img.shape[1])
-            img_file_name = ''.join([str(i) for i in attr]) + f'_{i}.png'
-            img_file_path = os.path.join(save_dir, res, img_file_name)
-            plt.imsave(img_file_path, img)
-            i += 1
+            Image.fromarray(img).save(os.path.join(save_dir, res, name))
+            count += 1
+        return count
+
+    # the number of records is known from headers, the shape from the first
+    num_records = len(index_tfrecord(tfr_file))
+    if num_records == 0:
+        return 0
+    images = iter_tfrecord_images(tfr_file)
+    name, first = next(images)
+    keys = [name]
+
+    def iter_images():
+        yield first
+        for name, img in images:
+            keys.append(name)
+            yield img
+
+    try:
+        write_packed(pack_dir, first.shape[1], keys, iter_images(),
+                     first.shape, num_records)
+    finally:
+        images.close()
+    return num_records
+
+
+def extract_tfrecord(tfr_files, save_dir, pack_dir=None, num_workers=None):
+    """Extract tfrecord files in parallel.
+
+    Args:
+        tfr_files: tfrecord file paths.
+        save_dir: directory path for saving images.
+        pack_dir: directory path for saving packed arrays instead of png
+                  files, Default is None.
+        num_workers: the number of processes, Default is None (# of cpus).
+    """
+    args = [(f, save_dir, pack_dir) for f in tfr_files]
+    with Pool(num_workers) as pool:
+        for f, count in zip(tfr_files,
+                            pool.starmap(extract_tfrecord_file, args)):
+            print('%s: %d images' % (f, count))
 
 
 def make_sub_dirs(save_dir):
@@ -77,10 +147,19 @@ if __name__ == '__main__':
     parser.add_argument('--save_dir',
                         default='../test_data/celebA/tfrecord/',
                         help='Directory for save png files')
+    parser.add_argument('--pack_dir',
+                        default=None,
+                        help='Directory for save packed arrays instead of '
+                             'png files')
+    parser.add_argument('--num_workers',
+                        default=None, type=int,
+                        help='The number of processes, Default is # of cpus')
     args = parser.parse_args()
 
-    print("Make Dirs")
-    make_sub_dirs(args.save_dir)
     tfr_files = load_tfrecord_from_dir(args.tfr_dir)
-    extract_tfrecord_png(tfr_files, args.save_dir)
+    if args.pack_dir is None:
+        print("Make Dirs")
+        make_sub_dirs(args.save_dir)
+    extract_tfrecord(tfr_files, args.save_dir, args.pack_dir,
+                     args.num_workers)
     print("End")
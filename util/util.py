@@ -3,6 +3,8 @@
 This file includes enumeration classe and utility functions.
 """
 import torch
+import random
+import numpy as np
 from enum import Enum
 import importlib
 
@@ -140,6 +142,39 @@ class DiscriminatorLoss:
         self.pixel_loss_syn = 0
 
 
+class LoaderStats:
+    """Statistics of data loading.
+
+    Attributes:
+        data_time : time the last step waited for data (sec)
+        total_data_time : time all steps of the layer waited for data (sec)
+        hidden_time : data time of the last step hidden by prefetching (sec)
+        total_hidden_time : data time of the layer hidden by prefetching (sec)
+
+    """
+
+    def __init__(self):
+        """Init attributes."""
+        self.reset()
+
+    def reset(self):
+        """Reset statistics of the layer."""
+        self.data_time = 0
+        self.total_data_time = 0
+        self.hidden_time = 0
+        self.total_hidden_time = 0
+
+    def update_data_time(self, data_time):
+        """Record the waiting time for data of a step."""
+        self.data_time = data_time
+        self.total_data_time += data_time
+
+    def update_hidden_time(self, hidden_time):
+        """Record the data time of a step hidden by prefetching."""
+        self.hidden_time = hidden_time
+        self.total_hidden_time += hidden_time
+
+
 # ----------------------------------------------------------------------------
 # Utilities for Tensor and Other Types
 def tofloat(use_cuda, var):
@@ -151,9 +186,8 @@ def tofloat(use_cuda, var):
 
     """
     if use_cuda:
-        var = var.cuda().float()
-    var = var.float()  # should be deleted
-    return var
+        var = var.cuda()
+    return var.float()
 
 
 def numpy2tensor(use_cuda, var):
@@ -238,6 +272,23 @@ def normalize_min_max(img):
     return img
 
 
+# ----------------------------------------------------------------------------
+# Utilities for DataLoader
+def seed_worker(worker_id):
+    """Seed random modules of a DataLoader worker.
+
+    Transforms draw random values from `random` and `numpy.random`, so each
+    worker is seeded from its own torch seed (base seed + worker id).
+
+    Args:
+        worker_id: id of the worker
+
+    """
+    seed = torch.initial_seed() % 2**32
+    random.seed(seed)
+    np.random.seed(seed)
+
+
 # ----------------------------------------------------------------------------
 # Utilities for importing modules and objects by name.
 def import_module(module_or_obj_name):